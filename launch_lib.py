@@ -20,11 +20,12 @@ def add_options(parser):
   parser.add_argument('--pop_size', type=int, help='max pop size')
   parser.add_argument('--fast_cpu', action="store_true", help='run agents faster on haswell cpus')
   parser.add_argument('-f', '--fixed_enemy', action="store_true", help="don't update enemy live")
+  parser.add_argument('--aggregate', action="store_true", help="route actor traffic through one aggregator per node")
 
 
 def launch(
   args, name, command, cpus=2, mem=1, gpu=False, log=True, qos=None,
-  array=None, depends=None, pids=[]):
+  array=None, depends=None, pids=[], prelude=None):
 
   #command = "LD_PRELOAD=$OM_USER/lib/libtcmalloc.so.4 " + command
   if gpu:
@@ -93,6 +94,8 @@ def launch(
       else:
         f.write("source activate tf-cpu-opt\n")
       f.write("sleep 40s\n")
+    if prelude:
+      f.write(prelude + "\n")
     f.write(command)
 
   #command = "screen -S %s -dm srun --job-name %s --pty singularity exec -B $OM_USER/phillip -B $HOME/phillip/ -H ../home phillip.img gdb -ex r --args %s" % (name[:10], name, command)
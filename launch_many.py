@@ -98,6 +98,21 @@ for enemy_path, _, enemy_id in agents:
     enemy_command += " --enemy_id %d" % enemy_id
   enemy_commands.append(enemy_command)
 
+def run_aggregator(path, params, pop_id):
+  "Starts a local aggregator, or returns a slurm prelude keeping one alive per node."
+  command = "python3 -u phillip/aggregator.py --load " + path
+  if pop_id >= 0:
+    command += " --pop_id %d" % pop_id
+  
+  if args.local:
+    command += " --trainer_ip 127.0.0.1"
+    launch(args, "aggregator_" + params['name'], command, pids=pids)
+    return None
+  
+  # every job on the node tries for the lock, so one takes over if the holder exits
+  lock = "/tmp/phillip_aggregator_%s.lock" % util.hashString(path + str(pop_id))
+  return "(while true; do flock -n %s %s; sleep 10; done) &" % (lock, command)
+
 def run_agents(path, params, pop_id):
   actors = args.agents or params.get('agents', 1)
 
@@ -117,6 +132,11 @@ def run_agents(path, params, pop_id):
   if args.local:
     common_command += " --dual_core 0"
   
+  prelude = None
+  if args.aggregate and not args.disk:
+    prelude = run_aggregator(path, params, pop_id)
+    common_command += " --aggregator 1"
+  
   common_command += " --dolphin --exe dolphin-emu-headless"
   common_command += " --zmq 1 --pipe_count 1"
   common_command += " --random_swap"
@@ -140,6 +160,7 @@ def run_agents(path, params, pop_id):
       array=actors_per_enemy,
       depends=trainer_depends,
       pids=pids,
+      prelude=prelude,
     )
 
 if run_agents_b:
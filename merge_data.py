@@ -1,45 +1,122 @@
 #!/usr/bin/env python3
 
-import numpy as np
-import glob
-from phillip import util
-import pickle
-
-use_hickle = True
-if use_hickle:
-  import hickle
+"""
+Compacts experience dumps into a columnar dataset (see phillip/columnar.py).
 
-path = "experience/FalconFalconBF"
+Inputs are directories of sealed segments and/or legacy one-file-per-trajectory
+dumps. Files are decoded in parallel, and inputs that were merged by a previous
+run are skipped, so the same command can be rerun to append new data.
+"""
 
-def load_experience(path):
-  with open(path, 'rb') as f:
-    return pickle.load(f)
+import os
+import glob
+import time
+from argparse import ArgumentParser
+from multiprocessing import Pool
+from phillip import util, codec, store, columnar
+from phillip.dataset import stack
 
 def prune_experience(experience):
   state = experience['state']
   state['players'] = state['players'][:2]
   return experience
 
-prune_load = util.compose(prune_experience, load_experience)
+prune_load = util.compose(prune_experience, codec.decode_obj)
+
+def load_records(records):
+  if len(records) == 0:
+    return None
+  return stack([prune_load(r) for r in records])
+
+def load_task(task):
+  """Decodes a segment or a group of legacy files into a stacked batch.
+
+  Returns:
+    The task's name and paths, the batch, and the error if it couldn't be
+    loaded (in which case the batch is None).
+  """
+  name, paths = task
+  try:
+    if name.endswith(store.SUFFIX):
+      records = store.Segment(paths[0])
+    else:
+      records = []
+      for p in paths:
+        with open(p, 'rb') as f:
+          records.append(f.read())
+    return name, paths, load_records(records), None
+  except Exception as e:
+    return name, paths, None, e
+
+def describe_task(name, paths):
+  if name != 'legacy':
+    return name
+  return '%d legacy files from %s' % (len(paths), paths[0])
+
+def make_tasks(inputs, skip, group_size):
+  tasks = []
+  legacy = []
+
+  for directory in inputs:
+    for p in sorted(glob.glob(os.path.join(directory, '*'))):
+      name = os.path.basename(p)
+      if name in skip or p.endswith(store.OPEN_SUFFIX) or not os.path.isfile(p):
+        continue
+      if p.endswith(store.SUFFIX):
+        tasks.append((name, [p]))
+      else:
+        legacy.append(p)
+
+  for paths in util.chunk(legacy, group_size):
+    tasks.append(('legacy', paths))
+
+  return tasks
+
+def main():
+  parser = ArgumentParser()
+  parser.add_argument('inputs', nargs='+', help='directories of experience dumps')
+  parser.add_argument('--out', type=str, required=True, help='columnar dataset to create or append to')
+  parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of decoding processes')
+  parser.add_argument('--group', type=int, default=256, help='legacy files decoded per task')
+  parser.add_argument('--recover', action='store_true', help='seal segments left open by dead actors first')
+  parser.add_argument('--recover_age', type=float, default=300., help='seconds since its last write before an open segment counts as abandoned')
+  args = parser.parse_args()
 
-paths = glob.glob(path+'/*')[:100]
-experiences = []
-for i, p in enumerate(paths):
-  if i % 10 == 0:
-    print('reading %d/%d' % (i, len(paths)))
-  experiences.append(prune_load(p))
+  if args.recover:
+    for directory in args.inputs:
+      for p in glob.glob(os.path.join(directory, '*' + store.SUFFIX + store.OPEN_SUFFIX)):
+        recovered = store.recover(p, args.recover_age)
+        if recovered:
+          print('recovered', recovered)
+        else:
+          print('left', p, 'open; its writer may be alive')
 
-def to_array(*xs):
-  return np.array(xs)
+  writer = columnar.ColumnarWriter(args.out)
+  tasks = make_tasks(args.inputs, writer.sources(), args.group)
+  print('merging %d tasks into %s (%d trajectories already there)' % (len(tasks), args.out, writer.count))
 
-merged = util.deepZipWith(to_array, *experiences)
-# hickle can't handle empty lists :(
-# but we don't want the initial state anyways
-del merged['initial']
+  start_time = time.time()
+  skipped = []
+  with Pool(args.workers) as pool:
+    for i, (name, paths, batch, error) in enumerate(pool.imap_unordered(load_task, tasks)):
+      if error is None and batch is not None:
+        sources = [name] if name != 'legacy' else list(map(os.path.basename, paths))
+        try:
+          writer.append(batch, sources)
+        except ValueError as e:
+          # e.g. a different schema from the rest of the dataset
+          error = e
+      if error is not None:
+        print('skipping %s: %s' % (describe_task(name, paths), error))
+        skipped.append(describe_task(name, paths))
+      if i % 10 == 0:
+        print('merged %d/%d, %d trajectories' % (i+1, len(tasks), writer.count))
 
-if use_hickle:
-  hickle.dump(merged, 'merged.hickle')
-else:
-  with open('merged.pickle', 'wb') as f:
-    pickle.dump(merged, f)
+  print('merged %d trajectories in %d seconds' % (writer.count, time.time() - start_time))
+  if skipped:
+    print('skipped %d inputs:' % len(skipped))
+    for s in skipped:
+      print(' ', s)
 
+if __name__ == '__main__':
+  main()
@@ -3,9 +3,14 @@ Parent RL class for Actor and Learner.
 """
 
 import os
+import sys
+import json
+import hashlib
+import traceback
 import tensorflow as tf
 import numpy as np
 from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
 from . import ssbm, tf_lib as tfl, util, embed
 from .default import Default, Option
 from .rl_common import *
@@ -52,15 +57,15 @@ class RL(Default):
     
     if self.name is None: self.name = "ActorCritic"
     if self.path is None: self.path = "saves/%s/" % self.name
-    # the below is a hack that makes it easier to run phillip from the command
-    # line, if we're doing PBT but don't want to specify the population ID. 
-    if self.evolve and self.pop_id < 0: self.pop_id = 0
+    self.pop_id = util.population_id(self.pop_id, self.evolve)
     if self.pop_id >= 0:
       self.root = self.path
-      self.path = os.path.join(self.path, str(self.pop_id))
+      self.path = util.population_path(self.path, self.pop_id)
       print(self.path)
     # where trained agents get saved onto disk. 
     self.snapshot_path = os.path.join(self.path, 'snapshot')
+    # which snapshot is current, for cheap change detection
+    self.manifest_path = os.path.join(self.path, 'manifest')
     self.actionType = ssbm.actionTypes[self.action_type]
 
     self.graph = tf.Graph()
@@ -99,18 +104,74 @@ class RL(Default):
         mutations.append(op)
     self.sess.run(mutations)
 
-  # save weights to disk
-  def save(self):
+  # save weights to disk; returns whether we started a save
+  def save(self, block=True):
     util.makedirs(self.path)
-    print("Saving to", self.path)
-    self.saver.save(self.sess, self.snapshot_path, write_meta_graph=False)
+    if block:
+      print("Saving to", self.path)
+      values, global_step = self.sess.run([self.variables, self.global_step])
+      self.saver.save(self.sess, self.snapshot_path, write_meta_graph=False)
+      self._write_manifest(values, global_step, self.snapshot_path)
+      return True
+
+    if self.save_future is not None and not self.save_future.done():
+      print("Previous save still in progress, skipping")
+      return False
+    
+    # copy everything to host memory at once and write it in the background
+    values, global_step = self.sess.run([self.variables, self.global_step])
+    if self.save_thread is None:
+      self.save_thread = ThreadPoolExecutor(1)
+    self.save_future = self.save_thread.submit(self._write_snapshot, values, global_step)
+    return True
+
+  def _write_snapshot(self, values, global_step):
+    try:
+      if self.checkpoint_writer is None:
+        self.checkpoint_writer = tfl.CheckpointWriter(self.variables)
+      path = self.checkpoint_writer.write(values, self.snapshot_path, global_step)
+      self._write_manifest(values, global_step, path)
+      print("Saved", path)
+    except Exception:
+      traceback.print_exc(file=sys.stderr)
+
+  def _write_manifest(self, values, global_step, checkpoint):
+    digest = hashlib.md5()
+    for value in values:
+      digest.update(np.ascontiguousarray(value).tobytes())
+    manifest = dict(
+      global_step=int(global_step),
+      hash=digest.hexdigest(),
+      checkpoint=os.path.basename(checkpoint),
+    )
+    with open(self.manifest_path + '.tmp', 'w') as f:
+      json.dump(manifest, f)
+    os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+  def read_manifest(self):
+    "The manifest of the current snapshot, or None if there isn't one."
+    try:
+      with open(self.manifest_path) as f:
+        return json.load(f)
+    except (IOError, ValueError):
+      return None
+
+  def latest_snapshot(self, manifest=None):
+    "Path of the current snapshot, going by the manifest if there is one."
+    if manifest is None:
+      manifest = self.read_manifest()
+    if manifest is not None:
+      return os.path.join(self.path, manifest['checkpoint'])
+    # background saves are numbered and published through the checkpoint file
+    return tf.train.latest_checkpoint(self.path) or self.snapshot_path
 
   # restore weights from disk
   def restore(self, path=None):
     if path is None:
-      path = self.snapshot_path
+      path = self.latest_snapshot()
     print("Restoring from", path)
-    tfl.restore(self.sess, self.variables, path)
+    # a single run, instead of one per variable
+    self.unblob(tfl.read_checkpoint(self.variables, path))
     # self.saver.restore(self.sess, path)
 
   # initializes weights
@@ -118,10 +179,12 @@ class RL(Default):
     self.sess.run(self.initializer)
 
   # currently enables Learner to serialize itself to send to Actors 
-  def blob(self):
+  def blob(self, variables=None):
+    if variables is None:
+      variables = self.variables
     with self.graph.as_default():
-      values = self.sess.run(self.variables)
-      return {var.name: val for var, val in zip(self.variables, values)}
+      values = self.sess.run(variables)
+      return {var.name: val for var, val in zip(variables, values)}
 
   # currently enables Actors to unserializing updated weights sent from a Learner
   def unblob(self, blob):
@@ -151,6 +214,11 @@ class RL(Default):
     self.placeholders = {v.name : tf.placeholder(v.dtype, v.get_shape()) for v in self.variables}
     self.unblobber = tf.group(*[tf.assign(v, self.placeholders[v.name]) for v in self.variables])
     
+    # for background saves, created on demand
+    self.checkpoint_writer = None
+    self.save_thread = None
+    self.save_future = None
+    
     self.graph.finalize()
 
     tf_config = dict(
@@ -93,8 +93,10 @@ class ActorCritic(Default):
     
     return taken_probs, taken_log_probs, entropy
 
-  def train(self, taken_log_probs, advantages, entropy):
+  def train(self, taken_log_probs, advantages, entropy, weights=None):
     actor_gain = taken_log_probs * tf.stop_gradient(advantages) + self.entropy_scale * entropy
+    if weights is not None:
+      actor_gain *= weights
     return -tf.reduce_mean(actor_gain) * self.actor_weight
 
   def getVariables(self):
@@ -1,5 +1,5 @@
 import tensorflow as tf
-from . import ssbm, actor, util, tf_lib as tfl, ctype_util as ct
+from . import ssbm, actor, util, tf_lib as tfl, ctype_util as ct, codec, dumper, store, catalog, dataset, schema, params
 import numpy as np
 from numpy import random, exp
 from .default import *
@@ -8,6 +8,11 @@ import pprint
 import os
 import uuid
 import pickle
+import atexit
+import time
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from . import reward
 
 pp = pprint.PrettyPrinter(indent=2)
@@ -21,14 +26,24 @@ class Agent(Default):
     Option('receive', action="store_true", help="receive parameters over network"),
     Option('trainer_id', type=str, help="trainer slurm job id"),
     Option('trainer_ip', type=str, help="trainer ip address"),
+    Option('aggregator', type=int, default=0, help="talk to the trainer through this node's aggregator"),
     Option('swap', type=int, default=0, help="swap players 1 and 2"),
     Option('disk', type=int, default=0, help="dump experiences to disk"),
+    Option('segment_size', type=int, default=64, help="size in MB at which on-disk experience segments are sealed"),
+    Option('segment_age', type=float, default=60., help="age in seconds at which on-disk experience segments are sealed"),
+    Option('compact', type=int, default=0, help="dump only the fields training reads, in narrow dtypes"),
+    Option('dump_batch', type=int, default=1, help="number of trajectories stacked into each experience message"),
+    Option('dump_deadline', type=float, help="max seconds to hold trajectories back for --dump_batch"),
+    Option('dump_queue', type=int, default=4, help="max trajectories waiting to be sent before the oldest is dropped"),
+    Option('credit_policy', type=str, default='none', choices=dumper.policies, help="what to do with dumps the trainer hasn't given us credit for"),
+    Option('subsample', type=float, default=0.1, help="fraction of uncredited dumps to send with --credit_policy subsample"),
     Option('real_delay', type=int, default=0, help="amount of delay in environment (due to netplay)"),
     Option('tb', action="store_true", help="log stats to tensorboard"),
   ]
   
   _members = [
-    ('actor', actor.Actor)
+    ('actor', actor.Actor),
+    ('codec', codec.Codec),
   ]
   
   def __init__(self, **kwargs):
@@ -47,8 +62,24 @@ class Agent(Default):
     avg_minutes = 30
     self.avg_reward = util.MovingAverage(1./(self.actor.config.fps * 60 * avg_minutes))
     
-    self.actor.restore()
+    # with background saves, the snapshot the manifest points to can be
+    # cleaned up before we read it, by which time the manifest has moved on
+    for attempt in range(3):
+      self.manifest = self.actor.read_manifest()
+      try:
+        self.actor.restore(self.actor.latest_snapshot(self.manifest))
+        break
+      except (tf.errors.OpError, ValueError) as e:
+        if attempt == 2:
+          raise e
+        print("Restore failed, retrying:", e)
+        time.sleep(1)
     self.global_step = self.actor.get_global_step()
+    
+    # disk reloads happen in the background; weights are swapped under the lock
+    self.actor_lock = threading.Lock()
+    self.reloader = None
+    self.reload_future = None
 
     self.dump = self.dump or self.trainer_id or self.trainer_ip
     self.receive = self.dump or self.receive
@@ -59,8 +90,9 @@ class Agent(Default):
       except ImportError as err:
         print("ImportError: {0}".format(err))
         sys.exit("Install nnpy to dump experiences")
+      from . import aggregator
 
-      if not self.trainer_ip:
+      if not (self.trainer_ip or self.aggregator):
         ip_path = os.path.join(self.actor.path, 'ip')
         if os.path.exists(ip_path):
           with open(ip_path, 'r') as f:
@@ -76,7 +108,10 @@ class Agent(Default):
 
       if self.dump:
         self.dump_socket = nnpy.Socket(nnpy.AF_SP, nnpy.PUSH)
-        sock_addr = "tcp://%s:%d" % (self.trainer_ip, util.port(self.actor.path + "/experience"))
+        if self.aggregator:
+          sock_addr = aggregator.local_address(self.actor.path, 'experience')
+        else:
+          sock_addr = "tcp://%s:%d" % (self.trainer_ip, util.port(self.actor.path + "/experience"))
         print("Connecting experience socket to " + sock_addr)
         self.dump_socket.connect(sock_addr)
 
@@ -84,26 +119,61 @@ class Agent(Default):
       self.params_socket.setsockopt(nnpy.SUB, nnpy.SUB_SUBSCRIBE, b"")
       self.params_socket.setsockopt(nnpy.SOL_SOCKET, nnpy.RCVMAXSIZE, -1)
       
-      address = "tcp://%s:%d" % (self.trainer_ip, util.port(self.actor.path + "/params"))
+      if self.aggregator:
+        address = aggregator.local_address(self.actor.path, 'params')
+      else:
+        address = "tcp://%s:%d" % (self.trainer_ip, util.port(self.actor.path + "/params"))
       print("Connecting params socket to", address)
       self.params_socket.connect(address)
+      self.params_decoder = params.Decoder()
 
     # prepare experience buffer
     if self.dump or self.disk:
       self.dump_size = self.actor.config.experience_length
-      self.dump_state_actions = (self.dump_size * ssbm.SimpleStateAction)()
 
       self.dump_frame = 0
       self.dump_count = 0
+      
+      self.dump_tag = uuid.uuid4().hex
+      # identifies this actor in message headers
+      self.dump_id = int(self.dump_tag[:16], 16)
+      
+      if self.compact:
+        self.dump_fields = schema.fields(self.actor.embedGame)
+      
+      # set by pair
+      self.leader = None
+      self.follower = None
+      
+      # trajectories waiting to be sent as one message
+      self.batch = []
+      self.batch_start = None
     
     if self.disk:
       self.dump_dir = os.path.join(self.actor.path, 'experience')
       print("Dumping to", self.dump_dir)
       util.makedirs(self.dump_dir)
-      self.dump_tag = uuid.uuid4().hex
+      self.segments = store.SegmentWriter(self.dump_dir, self.dump_tag, self.segment_size * 2**20, self.segment_age)
+      atexit.register(self.segments.close)
+      self.catalog = catalog.CatalogWriter(
+        os.path.join(self.dump_dir, catalog.DIR), self.dump_tag,
+        actor=self.dump_tag, pop_id=self.actor.pop_id, enemy=None)
+    
+    if self.dump or self.disk:
+      self.dumper = dumper.ExperienceDumper(
+        self.dump_size * ssbm.SimpleStateAction,
+        self.prepare_dump, self.send_dump,
+        max_queue=self.dump_queue,
+        policy=self.credit_policy if self.dump else 'none',
+        subsample=self.subsample,
+        idle=self.flush_dump if self.dump_deadline else None,
+        interval=self.dump_deadline)
     
     if self.tb:
       self.writer = tf.summary.FileWriterCache.get(self.actor.path)
+    
+    if self.receive and self.reload:
+      threading.Thread(target=self.receive_params, name='receive_params', daemon=True).start()
 
   def dump_state(self, state_action):
     #print(self.frame_counter)
@@ -111,7 +181,12 @@ class Agent(Default):
     if self.frame_counter < 300:
       return
     
-    self.dump_state_actions[self.dump_frame] = state_action
+    if self.leader:
+      self.leader.dumper.buffer[1][self.dump_frame] = state_action
+    elif self.follower:
+      self.dumper.buffer[0][self.dump_frame] = state_action
+    else:
+      self.dumper.buffer[self.dump_frame] = state_action
     
     if self.dump_frame == 0:
       self.initial = self.hidden
@@ -122,19 +197,135 @@ class Agent(Default):
       self.dump_count += 1
       self.dump_frame = 0
       
-      print("Dumping", self.dump_count)
+      if self.leader:
+        self.leader.pair_done(1, self.initial, self.global_step)
+        return
       
-      prepared = ssbm.prepareStateActions(self.dump_state_actions)
-      prepared['initial'] = self.initial
-      prepared['global_step'] = self.global_step
+      print("Dumping %d (dropped %d, late %d, throttled %d)" % (
+        self.dump_count, self.dumper.dropped, self.dumper.late, self.dumper.throttled))
       
-      if self.dump:
-        self.dump_socket.send(pickle.dumps(prepared))
-      
-      if self.disk:
-        path = os.path.join(self.dump_dir, self.dump_tag + '_%d' % self.dump_count)
-        with open(path, 'wb') as f:
-          pickle.dump(prepared, f)
+      if self.follower:
+        self.pair_done(0, self.initial, self.global_step)
+      else:
+        self.dumper.hand_off(initial=self.initial, global_step=self.global_step)
+
+  def pair(self, follower):
+    """Dumps follower's trajectories together with ours.
+
+    The two agents see the same game, so the game states are sent once and
+    the trainer reconstructs the follower's perspective (see schema.unpair).
+    This is only possible if both agents dump to the same trainer in lockstep.
+    
+    Returns:
+      Whether the agents were paired.
+    """
+    if not (self.dump and follower.dump) or self.disk or follower.disk:
+      return False
+    if follower.actor.path != self.actor.path:
+      return False
+    for field in ['experience_length', 'act_every']:
+      if getattr(follower.actor.config, field) != getattr(self.actor.config, field):
+        return False
+    
+    self.follower = follower
+    follower.leader = self
+    self.pair_meta = [None, None]
+    
+    self.dumper.reset_buffers((self.dump_size * ssbm.SimpleStateAction) * 2)
+    self.dumper.prepare = self.prepare_paired
+    self.dumper.send = self.send_paired
+    return True
+  
+  def pair_done(self, index, initial, global_step):
+    "Records that one of the paired agents has filled its trajectory."
+    self.pair_meta[index] = (initial, global_step)
+    if None in self.pair_meta:
+      return
+    
+    initial, global_step = map(list, zip(*self.pair_meta))
+    self.pair_meta = [None, None]
+    self.dumper.hand_off(initial=initial, global_step=global_step)
+
+  # These run on the dumper's thread.
+  def prepare_dump(self, state_actions, initial, global_step):
+    prepared = ssbm.prepareStateActions(state_actions)
+    prepared['initial'] = initial
+    prepared['global_step'] = global_step
+    
+    description = catalog.describe(prepared) if self.disk else None
+    if self.compact:
+      prepared = schema.narrow(schema.project(prepared, self.dump_fields))
+    return prepared, description
+  
+  def encode_dump(self, prepared):
+    return self.codec.encode(prepared, step=prepared['global_step'], source=self.dump_id)
+  
+  def send_dump(self, dump):
+    prepared, description = dump
+    blob = None
+    
+    if self.dump and self.dump_batch > 1:
+      if not self.batch:
+        self.batch_start = time.time()
+      self.batch.append(prepared)
+      self.flush_dump()
+    elif self.dump:
+      blob = self.encode_dump(prepared)
+      self.dump_socket.send(blob)
+    
+    if self.disk:
+      if blob is None:
+        blob = self.encode_dump(prepared)
+      location = self.segments.append(blob)
+      self.catalog.append(description, location)
+  
+  def flush_dump(self):
+    """Sends the batched trajectories, stacked along a leading batch axis.
+    
+    Unless the batch is full, waits until its oldest trajectory is dump_deadline
+    seconds old. The header step is the newest trajectory's.
+    """
+    if not self.batch:
+      return
+    if len(self.batch) < self.dump_batch:
+      if not self.dump_deadline or time.time() - self.batch_start < self.dump_deadline:
+        return
+    
+    batch, self.batch = self.batch, []
+    step = max(e['global_step'] for e in batch)
+    blob = self.codec.encode(dataset.stack(batch), step=step, source=self.dump_id,
+                             count=len(batch), flags=codec.BATCHED)
+    self.dump_socket.send(blob)
+  
+  def prepare_paired(self, state_actions, initial, global_step):
+    leader, follower = state_actions
+    prepared = ssbm.prepareStateActions(leader)
+    
+    frames = np.array([sa.state.frame for sa in follower])
+    if not np.array_equal(frames, prepared['state']['frame']):
+      # out of step; send both perspectives in full
+      print("Paired trajectories are misaligned, sending them separately.")
+      return [self.prepare_dump(sa, i, g)[0] for sa, i, g in zip(state_actions, initial, global_step)]
+    
+    actions = {f: [prepared[f], np.array([getattr(sa, f) for sa in follower])] for f in ['prev_action', 'action', 'prob']}
+    prepared.update(actions, initial=initial, global_step=global_step)
+    if self.compact:
+      prepared = schema.narrow(schema.project(prepared, self.dump_fields))
+    return [prepared]
+  
+  def send_paired(self, prepared):
+    for p in prepared:
+      if isinstance(p['global_step'], list):
+        blob = self.codec.encode(p, step=max(p['global_step']), source=self.dump_id,
+                                 count=2, flags=codec.PAIRED)
+      else:
+        blob = self.encode_dump(p)
+      self.dump_socket.send(blob)
+  
+  def set_enemy(self, enemy):
+    "Records who we're playing against in the experience catalog."
+    if self.disk:
+      self.catalog.fields['enemy'] = enemy
 
   # Given the current state, determine the action you'll take and send it to the Smash emulator. 
   # pad is a "game pad" object, for interfacing with the emulator
@@ -177,7 +368,8 @@ class Agent(Default):
     input_dict['delayed_action'] = self.actions.as_list()[1:]
     #print(input_dict['delayed_action'])
     
-    (action, prob), self.hidden = self.actor.act(input_dict, verbose=verbose)
+    with self.actor_lock:
+      (action, prob), self.hidden = self.actor.act(input_dict, verbose=verbose)
 
     #if verbose:
     #  pp.pprint(ct.toDict(state.players[1]))
@@ -198,43 +390,97 @@ class Agent(Default):
     if self.dump or self.disk:
       self.dump_state(current)
     
-    if self.reload:
-      if self.receive:
-        self.receive_params()
-      elif self.action_counter % (self.reload * self.actor.config.fps) == 0:
-        self.actor.restore()
-        self.global_step = self.actor.get_global_step()
+    # with self.receive, new parameters are applied by receive_params
+    if self.reload and not self.receive:
+      if self.action_counter % (self.reload * self.actor.config.fps) == 0:
+        self.reload_snapshot()
 
+  def reload_snapshot(self):
+    "Starts loading the snapshot on disk in the background, if it has changed."
+    if self.reload_future is not None and not self.reload_future.done():
+      return
+    
+    manifest = self.actor.read_manifest()
+    if manifest is not None and self.manifest is not None and manifest['hash'] == self.manifest['hash']:
+      return
+    
+    if self.reloader is None:
+      self.reloader = ThreadPoolExecutor(1)
+    self.reload_future = self.reloader.submit(self._reload, manifest)
 
-  # When called, ask the learner if there are new parameters. 
+  def _reload(self, manifest):
+    try:
+      blob = tfl.read_checkpoint(self.actor.variables, self.actor.latest_snapshot(manifest))
+    except Exception as e:
+      # e.g. the snapshot was cleaned up under us; try again next time
+      print("Reload failed:", e)
+      return
+    
+    with self.actor_lock:
+      self.actor.unblob(blob)
+    self.manifest = manifest
+    self.global_step = blob['global_step:0']
+
+
+  # Runs in the background, applying new parameters from the learner. 
   def receive_params(self):
     import nnpy
-    num_blobs = 0
-    latest = None
     
-    # get the latest update from the trainer
     while True:
       try:
-        #topic = self.socket.recv_string(zmq.NOBLOCK)
-        blob = self.params_socket.recv(nnpy.DONTWAIT)
-        params = pickle.loads(blob)
-        self.global_step = params['global_step:0']
-        latest = params
-        """
-        if global_step > self.global_step:
-          self.global_step = global_step
-          latest = params
-        else:
-          print("OUT OF ORDER?")
-        """
-        num_blobs += 1
-      except nnpy.NNError as e:
-        if e.error_no == nnpy.EAGAIN:
-          # nothing to receive
-          break
-        # a real error
-        raise e
-    
-    if latest is not None:
-      print("Unblobbing", self.global_step)
-      self.actor.unblob(latest)
+        # wait for a broadcast, then take whatever else has queued up
+        blobs = [self.params_socket.recv()]
+        while True:
+          try:
+            blobs.append(self.params_socket.recv(nnpy.DONTWAIT))
+          except nnpy.NNError as e:
+            if e.error_no == nnpy.EAGAIN:
+              break
+            raise e
+        
+        latest = self.decode_latest(blobs)
+      except Exception:
+        traceback.print_exc()
+        continue
+      
+      if latest is not None:
+        print("Unblobbing", latest['global_step:0'])
+        with self.actor_lock:
+          self.actor.unblob(latest)
+        self.global_step = latest['global_step:0']
+
+  def decode_latest(self, blobs):
+    """Decodes only as much of a backlog of broadcasts as we need.
+
+    That's the last keyframe and any deltas after it, which have to be applied
+    in order. Credits are read from every header.
+
+    Returns:
+      The newest parameters, or None if there are none we can use.
+    """
+    headers = [params.read_header(blob) for blob in blobs]
+    
+    start = 0
+    for i, header in enumerate(headers):
+      if header is not None and header.kind == params.KEYFRAME:
+        start = i
+    
+    latest = None
+    for i, (header, blob) in enumerate(zip(headers, blobs)):
+      if header is None:
+        # from an older trainer, with the credit in the body
+        values = pickle.loads(blob)
+        credit = values.pop('credit', params.NO_CREDIT)
+        if 'global_step:0' not in values:
+          values = None
+      else:
+        credit = header.credit
+        values = self.params_decoder.decode(header, blob) if i >= start else None
+      
+      # the trainer advertises experience credits with (or without) params
+      if credit != params.NO_CREDIT and self.dump:
+        self.dumper.grant(credit)
+      if values is not None:
+        latest = values
+    
+    return latest
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+"""
+Per-node aggregation of actor traffic.
+
+Actors on a node push their experiences to a local aggregator over ipc instead
+of each holding a tcp connection to the trainer. The aggregator forwards them
+in bundles of up to --bundle messages (or whatever arrived within --deadline
+seconds), optionally recompressed, so the trainer sees one sender per node.
+Parameters published by the trainer are likewise received once per node and
+republished locally.
+
+Run one aggregator per trainer per node, with the same --load and --pop_id as
+the actors, and give the actors --aggregator 1.
+"""
+
+import os
+import sys
+import time
+import threading
+import nnpy
+from phillip import util, codec
+from phillip.default import *
+
+def local_address(path, channel):
+  "The ipc address on which a node's aggregator serves a channel for path."
+  return "ipc:///tmp/phillip_%s_%s" % (util.hashString(path)[:16], channel)
+
+class Aggregator(Default):
+  _options = [
+    Option('path', type=str, help="path of the agent being trained"),
+    Option('pop_id', type=int, default=-1, help="population id of the agent being trained"),
+    Option('evolve', action="store_true", help="the agent is part of an evolving population"),
+    Option('trainer_id', type=str, help="trainer slurm job id"),
+    Option('trainer_ip', type=str, help="trainer ip address"),
+    Option('bundle', type=int, default=16, help="max experiences forwarded per message"),
+    Option('deadline', type=float, default=1., help="max seconds to hold experiences before forwarding"),
+  ]
+
+  _members = [
+    ('codec', codec.Codec),
+  ]
+
+  def __init__(self, load=None, **kwargs):
+    if load is None:
+      args = {}
+    else:
+      args = util.load_params(load, 'agent')
+
+    util.update(args, **kwargs)
+    Default.__init__(self, **args)
+
+    # resolved as in RL, so that we agree with actors and trainer
+    self.pop_id = util.population_id(self.pop_id, self.evolve)
+    self.path = util.population_path(self.path, self.pop_id)
+    # identifies this node in message headers
+    self.source = int(util.hashString(os.uname().nodename + self.path)[:16], 16)
+
+    if not self.trainer_ip:
+      ip_path = os.path.join(self.path, 'ip')
+      if os.path.exists(ip_path):
+        with open(ip_path, 'r') as f:
+          self.trainer_ip = f.read()
+        print("Read ip from disk", self.trainer_ip)
+      elif self.trainer_id:
+        from phillip import om
+        self.trainer_ip = om.get_job_ip(self.trainer_id)
+        print("Got ip from trainer jobid", self.trainer_ip)
+      else:
+        sys.exit("No trainer ip!")
+
+    # experiences: local actors -> us -> trainer
+    self.pull_socket = nnpy.Socket(nnpy.AF_SP, nnpy.PULL)
+    self.pull_socket.setsockopt(nnpy.SOL_SOCKET, nnpy.RCVMAXSIZE, -1)
+    self.pull_socket.setsockopt(nnpy.SOL_SOCKET, nnpy.RCVTIMEO, int(1000 * self.deadline))
+    address = local_address(self.path, 'experience')
+    print("Binding experience socket to", address)
+    self.pull_socket.bind(address)
+
+    self.push_socket = nnpy.Socket(nnpy.AF_SP, nnpy.PUSH)
+    address = "tcp://%s:%d" % (self.trainer_ip, util.port(self.path + "/experience"))
+    print("Connecting experience socket to", address)
+    self.push_socket.connect(address)
+
+    # params: trainer -> us -> local actors
+    self.sub_socket = nnpy.Socket(nnpy.AF_SP, nnpy.SUB)
+    self.sub_socket.setsockopt(nnpy.SUB, nnpy.SUB_SUBSCRIBE, b"")
+    self.sub_socket.setsockopt(nnpy.SOL_SOCKET, nnpy.RCVMAXSIZE, -1)
+    address = "tcp://%s:%d" % (self.trainer_ip, util.port(self.path + "/params"))
+    print("Connecting params socket to", address)
+    self.sub_socket.connect(address)
+
+    self.pub_socket = nnpy.Socket(nnpy.AF_SP, nnpy.PUB)
+    address = local_address(self.path, 'params')
+    print("Binding params socket to", address)
+    self.pub_socket.bind(address)
+
+    self.forwarded = 0
+    self.bundles = 0
+
+  def relay_params(self):
+    while True:
+      self.pub_socket.send(self.sub_socket.recv())
+
+  def forward(self, blobs):
+    if len(blobs) == 1 and self.codec.compress == 'none':
+      blob = blobs[0]
+    else:
+      blob = self.codec.encode_bundle(blobs, source=self.source)
+    self.push_socket.send(blob)
+
+    self.forwarded += len(blobs)
+    self.bundles += 1
+    if self.bundles % 100 == 0:
+      print("Forwarded %d experiences in %d messages" % (self.forwarded, self.bundles))
+
+  def run(self):
+    threading.Thread(target=self.relay_params, name='relay_params', daemon=True).start()
+
+    blobs = []
+    start = None
+    while True:
+      try:
+        blobs.append(self.pull_socket.recv())
+        if start is None:
+          start = time.time()
+      except nnpy.NNError as e:
+        if e.error_no != nnpy.ETIMEDOUT:
+          raise e
+
+      if blobs and (len(blobs) >= self.bundle or time.time() - start >= self.deadline):
+        self.forward(blobs)
+        blobs = []
+        start = None
+
+if __name__ == '__main__':
+  from argparse import ArgumentParser
+  parser = ArgumentParser()
+
+  for opt in Aggregator.full_opts():
+    opt.update_parser(parser)
+
+  parser.add_argument("--load", type=str, help="path to folder containing params")
+
+  args = parser.parse_args()
+  Aggregator(**args.__dict__).run()
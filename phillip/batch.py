@@ -0,0 +1,96 @@
+"""
+Time-major batches of experience, as fed to the learner.
+
+Per-frame fields are laid out [T, B, ...], which is what the learner's graph
+works with, so that nothing has to be transposed on either side of the feed.
+Per-trajectory fields (the initial hidden state and global_step) are [B, ...].
+"""
+
+import numpy as np
+from . import util
+
+# fields with a time axis; the rest are per trajectory
+time_fields = ['state', 'prev_action', 'action', 'prob', 'reward']
+
+def batch_axis(field):
+  return 1 if field in time_fields else 0
+
+def map_fields(f, batch):
+  "Applies f(x, axis) to every leaf, where axis is the leaf's batch axis."
+  return {k: util.deepMap(lambda x: f(x, batch_axis(k)), v) for k, v in batch.items()}
+
+def expand(experience):
+  "A single trajectory as a batch-major batch of one."
+  return util.deepMap(lambda x: np.asarray(x)[None], experience)
+
+def time_major(batch):
+  "Converts a batch-major batch (e.g. from dataset.stack) to time-major."
+  return map_fields(lambda x, axis: np.swapaxes(x, 0, 1) if axis else np.asarray(x), batch)
+
+def size(batch):
+  return len(batch['global_step'])
+
+def take(batch, indices):
+  "Gathers trajectories from a time-major batch."
+  return map_fields(lambda x, axis: np.take(x, indices, axis), batch)
+
+class BatchBuilder(object):
+  """Writes trajectories straight into preallocated time-major arrays.
+
+  Arrays for the next batch are allocated as soon as one is taken, shaped
+  after the first trajectories ever added.
+  """
+
+  def __init__(self, size):
+    self.size = size
+    self.template = None
+    self.arrays = None
+    self.count = 0
+
+  def _allocate(self):
+    def allocate(x, axis):
+      shape = list(x.shape[1:])
+      shape.insert(axis, self.size)
+      return np.empty(shape, dtype=x.dtype)
+    self.arrays = map_fields(allocate, self.template)
+    self.count = 0
+
+  def full(self):
+    return self.count == self.size
+
+  def add(self, chunk):
+    """Copies in as many trajectories as fit.
+
+    Args:
+      chunk: Trajectories stacked batch-major, e.g. from expand.
+    Returns:
+      The trajectories that didn't fit, or None.
+    """
+    if self.template is None:
+      self.template = util.deepMap(lambda x: x[:1], chunk)
+      self._allocate()
+
+    n = min(size(chunk), self.size - self.count)
+    begin, end = self.count, self.count + n
+
+    for k, v in chunk.items():
+      if k not in self.arrays:
+        continue
+      if batch_axis(k):
+        def write(array, x):
+          array[:, begin:end] = np.swapaxes(x[:n], 0, 1)
+      else:
+        def write(array, x):
+          array[begin:end] = x[:n]
+      util.deepZipWith(write, self.arrays[k], v)
+
+    self.count = end
+    if n == size(chunk):
+      return None
+    return util.deepMap(lambda x: x[n:], chunk)
+
+  def take(self):
+    "Returns the (full) batch and starts a new one."
+    batch = self.arrays
+    self._allocate()
+    return batch
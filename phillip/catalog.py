@@ -0,0 +1,194 @@
+"""
+Per-trajectory metadata for on-disk experience.
+
+Writers append one json line per trajectory to catalog/<tag>.jsonl inside the
+experience directory, recording where the trajectory lives (segment, offset,
+length) and a few summary statistics. Selecting trajectories then only needs
+the catalog, not the payloads. If the catalog is lost or stale it can be
+rebuilt by scanning the segments in parallel.
+"""
+
+import os
+import glob
+import json
+from multiprocessing import Pool
+import numpy as np
+from . import codec, store, reward, util
+
+DIR = 'catalog'
+
+def describe(experience):
+  "Summary statistics of a (decoded) trajectory."
+  state = experience['state']
+  players = state['players']
+
+  def first(x):
+    return int(x[0]) if x is not None else None
+
+  return dict(
+    global_step=int(experience['global_step']),
+    characters=[first(p.get('character')) for p in players],
+    stage=first(state.get('stage')),
+    reward=float(np.sum(experience['reward'])),
+    deaths=[int(np.sum(reward.deaths_np(p))) for p in players],
+  )
+
+class CatalogWriter(object):
+  """Appends catalog entries for one writer.
+
+  Extra fields (actor, enemy, pop_id, ...) are stored with every entry.
+  """
+
+  def __init__(self, directory, tag, **fields):
+    util.makedirs(directory)
+    self.path = os.path.join(directory, tag + '.jsonl')
+    self.fields = fields
+
+  def append(self, description, location):
+    segment, offset, length = location
+    entry = dict(self.fields, segment=segment, offset=offset, length=length, **description)
+    with open(self.path, 'a') as f:
+      f.write(json.dumps(entry) + '\n')
+
+def load_entries(directory):
+  """Catalog entries of the directory's sealed segments.
+
+  Entries are written as soon as a trajectory is, so some name segments that
+  are still open (or were left open by a crashed writer); those are skipped.
+  """
+  sealed = set(os.path.basename(p) for p in store.list_segments(directory))
+  entries = []
+  for path in sorted(glob.glob(os.path.join(directory, DIR, '*.jsonl'))):
+    with open(path) as f:
+      for line in f:
+        # the last line may be partially written
+        try:
+          entry = json.loads(line)
+        except ValueError:
+          continue
+        if entry['segment'] in sealed:
+          entries.append(entry)
+  return entries
+
+def _in_range(values, bounds):
+  lo, hi = bounds
+  mask = np.ones(len(values), dtype=bool)
+  if lo is not None:
+    mask &= values >= lo
+  if hi is not None:
+    mask &= values < hi
+  return mask
+
+class Catalog(object):
+  """In-memory, filterable view of an experience directory's catalog."""
+
+  def __init__(self, directory, entries=None):
+    self.directory = directory
+    if entries is None:
+      entries = load_entries(directory)
+    self.entries = entries
+
+    self.columns = {}
+    for key in ['actor', 'enemy', 'pop_id', 'segment']:
+      self.columns[key] = np.array([e.get(key) for e in entries], dtype=object)
+    for key in ['global_step', 'reward', 'stage', 'offset', 'length']:
+      self.columns[key] = np.array([e.get(key) for e in entries], dtype=np.float64)
+    for key in ['characters', 'deaths']:
+      values = [e.get(key) for e in entries] or np.zeros([0, 2])
+      self.columns[key] = np.array(values, dtype=np.float64)
+
+  def __len__(self):
+    return len(self.entries)
+
+  def select(self, actor=None, enemy=None, pop_id=None, stage=None, characters=None,
+             global_step=(None, None), reward=(None, None), deaths=(None, None)):
+    """Filters entries.
+
+    Equality filters (actor, enemy, pop_id, stage) also accept lists of allowed
+    values. characters is a per-player list, with None as a wildcard. The
+    range filters take (lo, hi) half-open bounds, either of which may be None;
+    deaths bounds the total deaths in the trajectory.
+
+    Returns:
+      A new Catalog with only the matching entries.
+    """
+    mask = np.ones(len(self), dtype=bool)
+
+    for key, value in [('actor', actor), ('enemy', enemy), ('pop_id', pop_id), ('stage', stage)]:
+      if value is None:
+        continue
+      if not isinstance(value, (list, tuple, set)):
+        value = [value]
+      mask &= np.isin(self.columns[key], list(value))
+
+    if characters is not None:
+      for i, c in enumerate(characters):
+        if c is not None:
+          mask &= self.columns['characters'][:, i] == c
+
+    mask &= _in_range(self.columns['global_step'], global_step)
+    mask &= _in_range(self.columns['reward'], reward)
+    mask &= _in_range(self.columns['deaths'].sum(-1), deaths)
+
+    return Catalog(self.directory, [e for e, m in zip(self.entries, mask) if m])
+
+  def records(self):
+    "Yields the selected (encoded) trajectories, a segment at a time."
+    segments = {}
+    for e in sorted(self.entries, key=lambda e: (e['segment'], e['offset'])):
+      name = e['segment']
+      if name not in segments:
+        segments.clear()
+        segments[name] = store.Segment(os.path.join(self.directory, name))
+      yield segments[name].record_at(e['offset'], e['length'])
+
+def _scan_segment(path):
+  segment = store.Segment(path)
+  actor = segment.name.rsplit('_', 1)[0]
+
+  entries = []
+  for offset, length in segment.index:
+    offset, length = int(offset), int(length)
+    description = describe(codec.decode_obj(segment.record_at(offset, length)))
+    entries.append(dict(actor=actor, segment=segment.name, offset=offset, length=length, **description))
+  return entries
+
+def rebuild(directory, workers=None):
+  """Rebuilds the catalog of an experience directory by scanning its segments.
+
+  Fields that can't be recovered from payloads (enemy, pop_id) are carried over
+  from the existing catalog where possible.
+  """
+  old = {(e['segment'], e['offset']): e for e in load_entries(directory)}
+
+  with Pool(workers) as pool:
+    scanned = pool.map(_scan_segment, store.list_segments(directory))
+
+  by_actor = {}
+  for entries in scanned:
+    for e in entries:
+      previous = old.get((e['segment'], e['offset']), {})
+      for key in ['enemy', 'pop_id']:
+        e[key] = previous.get(key)
+      by_actor.setdefault(e['actor'], []).append(e)
+
+  catalog_dir = os.path.join(directory, DIR)
+  util.makedirs(catalog_dir)
+  for actor, entries in by_actor.items():
+    path = os.path.join(catalog_dir, actor + '.jsonl')
+    with open(path + '.tmp', 'w') as f:
+      for e in entries:
+        f.write(json.dumps(e) + '\n')
+    os.replace(path + '.tmp', path)
+
+  return Catalog(directory)
+
+if __name__ == '__main__':
+  from argparse import ArgumentParser
+  parser = ArgumentParser(description="rebuild an experience catalog")
+  parser.add_argument('directory', type=str, help='experience directory')
+  parser.add_argument('--workers', type=int, help='number of scanning processes')
+  args = parser.parse_args()
+
+  catalog = rebuild(args.directory, args.workers)
+  print("Cataloged %d trajectories." % len(catalog))
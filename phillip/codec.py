@@ -0,0 +1,165 @@
+"""
+Wire format for experience payloads.
+
+Every message starts with a small fixed-size header saying how the body was
+encoded, followed by the (optionally delta-encoded and compressed) pickled body.
+Receivers don't need to be configured with the sender's codec: everything they
+need in order to decode is in the header.
+"""
+
+import pickle
+import struct
+import zlib
+import lzma
+from collections import namedtuple
+import numpy as np
+from . import util
+from .default import Default, Option
+
+MAGIC = b'PH'
+VERSION = 1
+
+# magic, version, compression, level, flags, count, step, source
+_header = struct.Struct('<2sBBBBHqQ')
+HEADER_SIZE = _header.size
+
+Header = namedtuple('Header', ['compression', 'level', 'flags', 'count', 'step', 'source'])
+
+# header flags
+DELTA = 1 << 0
+BUNDLE = 1 << 1  # body is a list of messages, e.g. from an aggregator
+BATCHED = 1 << 2  # body is count trajectories stacked along a leading axis
+PAIRED = 1 << 3  # body is two perspectives of the same game, see schema.unpair
+
+def _compress_lzma(data, level):
+  return lzma.compress(data, preset=level)
+
+compressors = dict(
+  none = (0, lambda data, level: data, lambda data: data),
+  zlib = (1, zlib.compress, zlib.decompress),
+  lzma = (2, _compress_lzma, lzma.decompress),
+)
+
+decompressors = {id_: decompress for id_, _, decompress in compressors.values()}
+
+# Delta encoding is done along the last axis, which is time for trajectories.
+# Floats are XOR'ed with their predecessor's bit pattern and ints are stored as
+# wrapping differences, so the round trip is bit-exact.
+
+def _unsigned(dtype):
+  return np.dtype('u%d' % dtype.itemsize)
+
+def _encodable(x):
+  return isinstance(x, np.ndarray) and x.ndim > 0 and x.shape[-1] > 1 and x.dtype.kind in 'biuf'
+
+def delta_encode(x):
+  if not _encodable(x):
+    return x
+
+  bits = x.view(_unsigned(x.dtype))
+  encoded = bits.copy()
+  if x.dtype.kind == 'f' or x.dtype.kind == 'b':
+    encoded[..., 1:] ^= bits[..., :-1]
+  else:
+    encoded[..., 1:] -= bits[..., :-1]
+  return encoded.view(x.dtype)
+
+def delta_decode(x):
+  if not _encodable(x):
+    return x
+
+  bits = x.view(_unsigned(x.dtype))
+  if x.dtype.kind == 'f' or x.dtype.kind == 'b':
+    decoded = np.bitwise_xor.accumulate(bits, axis=-1)
+  else:
+    decoded = np.cumsum(bits, axis=-1, dtype=bits.dtype)
+  return decoded.view(x.dtype)
+
+class Codec(Default):
+  _options = [
+    Option('compress', type=str, default='none', choices=compressors.keys(), help="compression for experience dumps"),
+    Option('compress_level', type=int, default=6, help="compression level, 0-9"),
+    Option('delta', type=int, default=1, help="delta encode experience columns before compressing"),
+  ]
+
+  def encode(self, obj, step=0, source=0, count=1, flags=0):
+    """Serializes obj into a message.
+
+    Args:
+      obj: A structure of numpy arrays, such as a prepared trajectory.
+      step: The global step at which obj was generated.
+      source: Integer id of the sender.
+      count: Number of trajectories in obj.
+      flags: Extra header flags describing obj.
+    Returns:
+      The encoded message, as bytes.
+    """
+    if self.delta and self.compress != 'none':
+      obj = util.deepMap(delta_encode, obj)
+      flags |= DELTA
+
+    return self._pack(obj, step, source, count, flags)
+
+  def encode_bundle(self, blobs, source=0):
+    """Packs several messages into one.
+
+    The bundle's step is that of its newest message. Receivers unbundle before
+    checking staleness, so that each message is counted against its own sender.
+    """
+    headers = [read_header(blob) for blob in blobs]
+    count = sum(h.count if h else 1 for h in headers)
+    step = max([h.step for h in headers if h] or [0])
+    return self._pack(list(map(bytes, blobs)), step, source, count, BUNDLE)
+
+  def _pack(self, obj, step, source, count, flags):
+    compression, compress, _ = compressors[self.compress]
+    body = compress(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL), self.compress_level)
+    header = _header.pack(MAGIC, VERSION, compression, self.compress_level, flags, count, step, source)
+    return header + body
+
+def read_header(blob):
+  """Reads only the header of a message.
+
+  Returns None for legacy (plain pickle) messages.
+  """
+  if blob[:len(MAGIC)] != MAGIC:
+    return None
+
+  magic, version, *fields = _header.unpack_from(blob)
+  if version != VERSION:
+    raise ValueError("Unsupported message version %d" % version)
+  return Header(*fields)
+
+def decode_body(header, blob):
+  body = memoryview(blob)[HEADER_SIZE:]
+  obj = pickle.loads(decompressors[header.compression](body))
+
+  if header.flags & DELTA:
+    obj = util.deepMap(delta_decode, obj)
+
+  return obj
+
+def unbundle(blob):
+  "Splits a message into its component messages (just itself if not a bundle)."
+  header = read_header(blob)
+  if header is None or not header.flags & BUNDLE:
+    return [blob]
+  return decode_body(header, blob)
+
+def decode(blob):
+  """Decodes a message.
+
+  Returns:
+    A (header, obj) pair. Legacy messages get a header synthesized from the body.
+  """
+  header = read_header(blob)
+
+  if header is None:
+    obj = pickle.loads(blob)
+    header = Header(0, 0, 0, 1, obj.get('global_step', 0), 0)
+    return header, obj
+
+  return header, decode_body(header, blob)
+
+def decode_obj(blob):
+  return decode(blob)[1]
@@ -0,0 +1,171 @@
+"""
+Background collection of experiences into training batches.
+
+One thread per source (the network, a tailed directory) receives messages,
+rejects stale ones from their headers and hands the rest to a pool of
+decoders. Another validates the decoded experiences, in arrival order, and
+writes them into time-major batches in a bounded queue, so that the trainer
+always has a batch waiting instead of alternating between collecting and
+training.
+"""
+
+import time
+import queue
+import threading
+import traceback
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from . import codec, schema, util, batch
+
+class Collector(object):
+
+  def __init__(self, recv, fields, batch_size, max_age=None, decode_threads=2, ready=2):
+    """
+    Args:
+      recv: Blocking function returning the next message, or a list of them,
+        each of which gets its own receiving thread.
+      fields: Experience fields to keep, as given by schema.fields.
+      batch_size: Number of trajectories per batch.
+      max_age: How many steps behind global_step an experience may be.
+      decode_threads: Size of the decoding pool.
+      ready: Maximum number of batches waiting to be trained on. When full,
+        the oldest waiting batch is dropped.
+    """
+    self.fields = fields
+    self.batch_size = batch_size
+    self.max_age = max_age
+
+    # set by the trainer as it trains
+    self.global_step = 0
+
+    # per-actor message counts, keyed by the source id in message headers
+    self.received = defaultdict(int)
+    self.dead = defaultdict(int)
+    # when we last heard from each actor
+    self.last_seen = {}
+
+    self.doa = 0  # dead on arrival
+    self.dropped = 0  # batches dropped while the trainer was busy
+
+    # the counters above are updated from the receiving and assembling threads
+    self.lock = threading.Lock()
+
+    # decompression releases the GIL, so this overlaps with receiving
+    self.decoder = ThreadPoolExecutor(decode_threads)
+    # bounds the number of experiences in flight
+    self.decoded = queue.Queue(4 * batch_size)
+
+    self.ready = deque()
+    self.max_ready = ready
+    self.cond = threading.Condition()
+
+    for recv in recv if isinstance(recv, list) else [recv]:
+      threading.Thread(target=self._receive, args=(recv,), name='_receive', daemon=True).start()
+    threading.Thread(target=self._assemble, name='_assemble', daemon=True).start()
+
+  def is_valid_step(self, step):
+    if self.max_age is None:
+      return True
+    return step >= self.global_step - self.max_age
+
+  def _reject(self, header):
+    "Rejects stale messages without decoding them."
+    stale = not self.is_valid_step(header.step)
+    with self.lock:
+      self.received[header.source] += header.count
+      self.last_seen[header.source] = time.time()
+      if stale:
+        self._count_dead(header.source, header.count)
+    return stale
+
+  def _count_dead(self, source, count):
+    "Must hold the lock."
+    self.dead[source] += count
+    self.doa += count
+
+  def _receive(self, recv):
+    while True:
+      try:
+        blob = recv()
+
+        # bundles from an aggregator are counted against the actors in them
+        for blob in codec.unbundle(blob):
+          header = codec.read_header(blob)
+          if header is not None and self._reject(header):
+            continue
+          self.decoded.put(self.decoder.submit(codec.decode, blob))
+      except Exception:
+        traceback.print_exc()
+
+  def _validate(self, header, exp):
+    "Splits a decoded message into stacked chunks of valid experiences."
+    # actors may or may not have projected their dumps already
+    exp = schema.project(exp, self.fields)
+
+    if header.flags & codec.BATCHED:
+      valid = np.ones(header.count, dtype=bool) & self.is_valid_step(exp['global_step'])
+      if not valid.all():
+        exp = util.deepMap(lambda x: x[valid], exp)
+      stale = header.count - int(valid.sum())
+      with self.lock:
+        self._count_dead(header.source, stale)
+      return [exp] if valid.any() else []
+
+    chunks = []
+    exps = schema.unpair(exp) if header.flags & codec.PAIRED else [exp]
+    for exp in exps:
+      if self.is_valid_step(exp['global_step']):
+        chunks.append(batch.expand(exp))
+      else:
+        with self.lock:
+          self._count_dead(header.source, 1)
+    return chunks
+
+  def _assemble(self):
+    builder = batch.BatchBuilder(self.batch_size)
+
+    while True:
+      try:
+        header, exp = self.decoded.get().result()
+        chunks = self._validate(header, exp)
+      except Exception:
+        traceback.print_exc()
+        continue
+
+      for chunk in chunks:
+        while chunk is not None:
+          chunk = builder.add(chunk)
+          if builder.full():
+            self._put(builder.take())
+
+  def _put(self, ready):
+    with self.cond:
+      if len(self.ready) == self.max_ready:
+        self.ready.popleft()
+        self.dropped += 1
+      self.ready.append(ready)
+      self.cond.notify()
+
+  def get(self, block=True):
+    """The next batch, in time-major layout (see batch.py).
+
+    If not blocking, returns None when no batch is ready.
+    """
+    with self.cond:
+      while block and not self.ready:
+        self.cond.wait()
+      return self.ready.popleft() if self.ready else None
+
+  def active(self, window):
+    "How many actors we've heard from in the last window seconds."
+    now = time.time()
+    with self.lock:
+      return sum(1 for t in self.last_seen.values() if now - t < window)
+
+  def print_doa(self, top=10):
+    with self.lock:
+      rates = {source: self.dead[source] / self.received[source] for source in self.received}
+    worst = sorted(rates, key=rates.get, reverse=True)[:top]
+    print("DOA rate by actor (of %d):" % len(rates),
+          ", ".join("%016x %.3f" % (source, rates[source]) for source in worst))
@@ -0,0 +1,227 @@
+"""
+Columnar on-disk experience datasets.
+
+A dataset is a directory with one raw array file per leaf field of the
+experience structure, with the trajectory axis first, plus a columns.json
+describing the structure, dtypes, shapes and number of trajectories. Columns
+are memory-mapped for reading and appended to in place.
+"""
+
+import os
+import json
+import numpy as np
+from . import util
+
+META = 'columns.json'
+# append-only log of merged inputs, one "<count>\t<name>" line each, where
+# count is the dataset's size once the input's batch was appended
+SOURCES = 'sources.log'
+
+def flatten(obj, path=()):
+  "Yields (path, leaf) pairs. Unlike util.deepItems, tuples are containers."
+  if isinstance(obj, dict):
+    for k in sorted(obj):
+      yield from flatten(obj[k], path + (k,))
+  elif isinstance(obj, (list, tuple)):
+    for i, v in enumerate(obj):
+      yield from flatten(v, path + (i,))
+  else:
+    yield path, obj
+
+def column_name(path):
+  return '.'.join(map(str, path))
+
+def skeleton(obj, path=()):
+  "A json-friendly description of obj's structure, with column names as leaves."
+  if isinstance(obj, dict):
+    return {'dict': {k: skeleton(v, path + (k,)) for k, v in obj.items()}}
+  if isinstance(obj, (list, tuple)):
+    kind = 'tuple' if isinstance(obj, tuple) else 'list'
+    return {kind: [skeleton(v, path + (i,)) for i, v in enumerate(obj)]}
+  return column_name(path)
+
+def rebuild(skel, columns):
+  "Inverse of skeleton: fills in leaves from a dict of column name -> value."
+  if isinstance(skel, str):
+    return columns[skel]
+  kind, value = next(iter(skel.items()))
+  if kind == 'dict':
+    return {k: rebuild(v, columns) for k, v in value.items()}
+  children = [rebuild(v, columns) for v in value]
+  return tuple(children) if kind == 'tuple' else children
+
+def _write_json(path, obj):
+  tmp = path + '.tmp'
+  with open(tmp, 'w') as f:
+    json.dump(obj, f)
+  os.replace(tmp, path)
+
+class ColumnarWriter(object):
+  """Appends batches of trajectories to a (possibly existing) dataset."""
+
+  def __init__(self, path):
+    self.path = path
+    util.makedirs(path)
+
+    meta_path = os.path.join(path, META)
+    if os.path.exists(meta_path):
+      with open(meta_path) as f:
+        self.meta = json.load(f)
+      self._truncate()
+    else:
+      self.meta = None
+
+    self._sources = self._load_sources()
+
+  def _column_path(self, name):
+    return os.path.join(self.path, name + '.bin')
+
+  def _row_bytes(self, column):
+    return np.dtype(column['dtype']).itemsize * int(np.prod(column['shape']))
+
+  def _truncate(self):
+    # drop anything written after the last successful append
+    for name, column in self.meta['columns'].items():
+      with open(self._column_path(name), 'r+b') as f:
+        f.truncate(self.meta['count'] * self._row_bytes(column))
+
+  @property
+  def count(self):
+    return self.meta['count'] if self.meta else 0
+
+  def _load_sources(self):
+    "Reads the sources log, dropping entries of appends that didn't complete."
+    path = os.path.join(self.path, SOURCES)
+    lines = []
+    rewrite = False
+
+    if os.path.exists(path):
+      with open(path) as f:
+        for line in f:
+          n, _, name = line.rstrip('\n').partition('\t')
+          if line.endswith('\n') and name and n.isdigit() and int(n) <= self.count:
+            lines.append(line)
+          else:
+            rewrite = True
+
+    # older datasets kept their sources in the metadata
+    legacy = self.meta.pop('sources', None) if self.meta else None
+    if legacy:
+      lines.extend('%d\t%s\n' % (self.count, name) for name in legacy)
+      rewrite = True
+
+    if rewrite:
+      with open(path + '.tmp', 'w') as f:
+        f.writelines(lines)
+      os.replace(path + '.tmp', path)
+    if legacy:
+      _write_json(os.path.join(self.path, META), self.meta)
+
+    return set(line.rstrip('\n').partition('\t')[2] for line in lines)
+
+  def sources(self):
+    "Names of inputs that have already been appended."
+    return set(self._sources)
+
+  def append(self, batch, sources=()):
+    """Appends trajectories.
+
+    Args:
+      batch: An experience structure whose leaves have a leading batch axis.
+      sources: Names of the inputs the batch came from, recorded in the metadata.
+    """
+    leaves = [(column_name(p), np.asarray(x)) for p, x in flatten(batch)]
+
+    if self.meta is None:
+      self.meta = dict(
+        count=0,
+        structure=skeleton(batch),
+        columns={name: dict(dtype=x.dtype.str, shape=list(x.shape[1:])) for name, x in leaves},
+      )
+      # clear out anything left by a first append that crashed before the metadata
+      for name in self.meta['columns']:
+        open(self._column_path(name), 'wb').close()
+
+    # check everything before writing anything, so that columns stay aligned
+    names = set(name for name, _ in leaves)
+    expected = set(self.meta['columns'])
+    if names != expected:
+      raise ValueError("Batch columns don't match the dataset's: missing %s, extra %s" %
+                       (sorted(expected - names), sorted(names - expected)))
+
+    size = len(leaves[0][1])
+    for name, x in leaves:
+      column = self.meta['columns'][name]
+      if list(x.shape[1:]) != column['shape']:
+        raise ValueError("Column %s has shape %s, expected %s" % (name, x.shape[1:], column['shape']))
+      if len(x) != size:
+        raise ValueError("Column %s has %d trajectories, expected %d" % (name, len(x), size))
+
+    for name, x in leaves:
+      column = self.meta['columns'][name]
+      with open(self._column_path(name), 'ab') as f:
+        f.write(np.ascontiguousarray(x, dtype=column['dtype']).tobytes())
+
+    count = self.meta['count'] + size
+    if sources:
+      with open(os.path.join(self.path, SOURCES), 'a') as f:
+        f.write(''.join('%d\t%s\n' % (count, name) for name in sources))
+    self.meta['count'] = count
+    _write_json(os.path.join(self.path, META), self.meta)
+    self._sources.update(sources)
+
+class ColumnarDataset(object):
+  """Random access to a columnar dataset through memory maps."""
+
+  def __init__(self, path, indices=None):
+    self.path = path
+    with open(os.path.join(path, META)) as f:
+      self.meta = json.load(f)
+
+    count = self.meta['count']
+    self.columns = {}
+    for name, column in self.meta['columns'].items():
+      if count:
+        self.columns[name] = np.memmap(
+          os.path.join(path, name + '.bin'), dtype=column['dtype'], mode='r',
+          shape=tuple([count] + column['shape']))
+      else:
+        self.columns[name] = np.empty([0] + column['shape'], dtype=column['dtype'])
+
+    if indices is None:
+      indices = np.arange(count)
+    self.indices = indices
+
+  @staticmethod
+  def exists(path):
+    return os.path.exists(os.path.join(path, META))
+
+  def __len__(self):
+    return len(self.indices)
+
+  def split(self, n):
+    "Splits off the first n trajectories, e.g. for validation."
+    first = ColumnarDataset.__new__(ColumnarDataset)
+    rest = ColumnarDataset.__new__(ColumnarDataset)
+    for d, indices in [(first, self.indices[:n]), (rest, self.indices[n:])]:
+      d.path, d.meta, d.columns, d.indices = self.path, self.meta, self.columns, indices
+    return first, rest
+
+  def get(self, indices):
+    "Gathers the given trajectories into a stacked batch."
+    columns = {name: column[indices] for name, column in self.columns.items()}
+    return rebuild(self.meta['structure'], columns)
+
+  def _batches(self, batch_size, seed):
+    rng = np.random.RandomState(seed)
+    order = rng.permutation(self.indices)
+    for i in range(0, len(order), batch_size):
+      # sorted reads are friendlier to the page cache
+      yield self.get(np.sort(order[i:i+batch_size]))
+
+  def batches(self, batch_size, shuffle_buffer=None, prefetch=4, seed=None):
+    """One epoch of shuffled minibatches, gathered on a background thread.
+
+    shuffle_buffer is unused; with random access the whole dataset is shuffled.
+    """
+    return util.prefetch(self._batches(batch_size, seed), prefetch)
@@ -37,6 +37,7 @@ class CPU(Default):
       Option('tcp', type=int, default=0, help="use zmq over tcp for memory watcher and pipe input"),
       Option('windows', action='store_true', help="set defaults for windows"),
       Option('enemy_dump', type=int, default=0, help="also dump frames for the enemy"),
+      Option('pair_dumps', type=int, default=0, help="in self-play, send the enemy's dumps along with ours, sharing game states"),
     ] + [Option('p%d' % i, type=str, choices=characters.keys(), default="falcon", help="character for player %d" % i) for i in [1, 2]]
     
     _members = [
@@ -75,6 +76,10 @@ class CPU(Default):
                 dump=self.enemy_dump,
                 pop_id=self.enemy_id,
                 gpu=self.agent.actor.gpu,
+                compress=self.agent.codec.compress,
+                compress_level=self.agent.codec.compress_level,
+                delta=self.agent.codec.delta,
+                compact=self.agent.compact,
             )
             enemy = agent.Agent(**enemy_kwargs)
         
@@ -82,11 +87,22 @@ class CPU(Default):
             self.agents[enemy_pid] = enemy
             self.cpus[enemy_pid] = None
             self.characters[enemy_pid] = enemy.char or self.p1
+            
+            self.agent.set_enemy(enemy.actor.path)
+            enemy.set_enemy(self.agent.actor.path)
+            
+            if self.pair_dumps and self.enemy_dump:
+                if self.agent.pair(enemy):
+                    print("Pairing experience dumps with the enemy.")
+                else:
+                    print("Can't pair experience dumps with the enemy.")
         elif self.cpu:
             self.pids.append(enemy_pid)
             self.agents[enemy_pid] = None
             self.cpus[enemy_pid] = self.cpu
             self.characters[enemy_pid] = self.p1
+            
+            self.agent.set_enemy('cpu%d' % self.cpu)
 
         
         print('Creating MemoryWatcher.')
@@ -38,7 +38,7 @@ class Critic(Default):
     
     self.variables = self.net.getVariables()
   
-  def __call__(self, inputs, rewards, prob_ratios, **unused):
+  def __call__(self, inputs, rewards, prob_ratios, weights=None, **unused):
     values = tf.squeeze(self.net(inputs), [-1])
     trainVs = values[:-1]
     lastV = values[-1]
@@ -52,7 +52,11 @@ class Critic(Default):
     tf.summary.scalar('advantage_avg', advantage_avg)
     tf.summary.scalar('advantage_std', tf.sqrt(tfl.sample_variance(advantages)))
     
-    vLoss = tf.reduce_mean(tf.square(advantages))
+    # per-trajectory importance sampling weights, e.g. for prioritized replay
+    if weights is None:
+      vLoss = tf.reduce_mean(tf.square(advantages))
+    else:
+      vLoss = tf.reduce_mean(tf.square(advantages) * weights)
     tf.summary.scalar('v_loss', vLoss)
     tf.summary.scalar("v_uev", vLoss / tfl.sample_variance(targets))
     
@@ -0,0 +1,111 @@
+"""
+Streaming minibatches from on-disk experience, for offline training.
+"""
+
+import os
+import numpy as np
+from . import codec, store, util
+
+def stack(experiences):
+  "Stacks a list of trajectories along a new leading batch axis."
+  return util.deepZipWith(lambda *xs: np.stack(xs), *experiences)
+
+def concat(batches):
+  "Joins stacked batches along their leading batch axis."
+  return util.deepZipWith(lambda *xs: np.concatenate(xs), *batches)
+
+class ShardDataset(object):
+  """Shuffled minibatches over a directory of sealed segments.
+
+  Segments are memory-mapped, so only the shuffle buffer and the prefetched
+  batches are ever decoded in memory. Each epoch visits the segments in a new
+  random order, and the records within each segment in a new random order;
+  a shuffle buffer then mixes records across neighbouring segments.
+  """
+
+  def __init__(self, path=None, segments=None, records=None, limit=0):
+    """
+    Args:
+      path: A directory of segments.
+      segments: Already opened segments, instead of path.
+      records: An [N, 2] array of (segment, record) indices to restrict to.
+      limit: Maximum number of segments to use; 0 means no limit.
+    """
+    if segments is None:
+      paths = store.list_segments(path)
+      if limit:
+        paths = paths[:limit]
+      segments = [store.Segment(p) for p in paths]
+    self.segments = segments
+
+    if records is None:
+      records = [(s, r) for s, segment in enumerate(segments) for r in range(len(segment))]
+      records = np.array(records, dtype=np.int64).reshape([-1, 2])
+    self.records = records
+
+    # records are kept grouped by segment
+    _, starts = np.unique(records[:, 0], return_index=True)
+    self.groups = np.split(records, starts[1:]) if len(records) else []
+
+  @classmethod
+  def from_catalog(cls, catalog):
+    "A dataset of the trajectories selected in a catalog.Catalog."
+    names = sorted(set(e['segment'] for e in catalog.entries))
+    segments = [store.Segment(os.path.join(catalog.directory, name)) for name in names]
+    numbers = {name: s for s, name in enumerate(names)}
+
+    records = []
+    for e in sorted(catalog.entries, key=lambda e: (e['segment'], e['offset'])):
+      s = numbers[e['segment']]
+      r = np.searchsorted(segments[s].index[:, 0], e['offset'])
+      records.append((s, r))
+    records = np.array(records, dtype=np.int64).reshape([-1, 2])
+
+    return cls(segments=segments, records=records)
+
+  def __len__(self):
+    return len(self.records)
+
+  def split(self, n):
+    "Splits off the first n records, e.g. for validation."
+    return (
+      ShardDataset(segments=self.segments, records=self.records[:n]),
+      ShardDataset(segments=self.segments, records=self.records[n:]),
+    )
+
+  def _epoch_order(self, rng):
+    for g in rng.permutation(len(self.groups)):
+      records = self.groups[g].copy()
+      rng.shuffle(records)
+      yield from records
+
+  def _shuffled(self, rng, shuffle_buffer):
+    buffer = []
+    for s, r in self._epoch_order(rng):
+      buffer.append(codec.decode_obj(self.segments[s][r]))
+      if len(buffer) >= shuffle_buffer:
+        i = rng.randint(len(buffer))
+        buffer[i], buffer[-1] = buffer[-1], buffer[i]
+        yield buffer.pop()
+
+    rng.shuffle(buffer)
+    yield from buffer
+
+  def _batches(self, batch_size, shuffle_buffer, seed):
+    rng = np.random.RandomState(seed)
+    batch = []
+    for experience in self._shuffled(rng, shuffle_buffer):
+      batch.append(experience)
+      if len(batch) == batch_size:
+        yield stack(batch)
+        batch = []
+
+    if batch:
+      yield stack(batch)
+
+  def batches(self, batch_size, shuffle_buffer=1024, prefetch=4, seed=None):
+    """One epoch of stacked minibatches, prepared on a background thread.
+
+    The batches can be passed directly to Learner.train with zipped=True.
+    """
+    return util.prefetch(self._batches(batch_size, shuffle_buffer, seed), prefetch)
@@ -0,0 +1,159 @@
+"""
+Background preparation and sending of experience dumps.
+
+The frame loop writes state-actions into a ctypes buffer and hands it off when
+it fills up; everything after that (vectorizing, computing rewards, encoding,
+network and disk I/O) happens on a separate thread.
+"""
+
+import threading
+import traceback
+import random
+from collections import deque
+
+# what to do with trajectories we have no credit for
+policies = ['none', 'skip', 'subsample', 'buffer']
+
+class ExperienceDumper(object):
+  """Multi-buffered hand-off of trajectories to a sender thread.
+
+  There are max_queue + 2 buffers: one being filled by the frame loop, one being
+  prepared by the sender thread, and up to max_queue waiting in between. If the
+  sender falls behind the oldest waiting trajectory is dropped, so hand_off
+  never blocks.
+
+  Sending can also be gated on credits granted by the trainer. Without credit,
+  trajectories are dropped before being prepared ('skip'), dropped except for a
+  random fraction ('subsample'), or held in the queue until credit arrives
+  ('buffer'). Until the first grant there is no limit.
+  """
+
+  def __init__(self, buffer_type, prepare, send, max_queue=4, policy='none', subsample=0.1,
+               idle=None, interval=None):
+    """
+    Args:
+      buffer_type: The ctypes array type to fill with state-actions.
+      prepare: Called on the sender thread with a full buffer and the metadata
+        passed to hand_off. Must copy out whatever it needs from the buffer.
+      send: Called on the sender thread with the output of prepare.
+      max_queue: Maximum number of trajectories waiting to be prepared.
+      policy: One of policies, for when there is no credit.
+      subsample: Fraction of uncredited trajectories sent with 'subsample'.
+      idle: Called on the sender thread when nothing has been handed off for
+        interval seconds, and then every interval seconds until something is.
+      interval: Seconds between calls to idle.
+    """
+    self.prepare = prepare
+    self.send = send
+    self.idle = idle
+    self.interval = interval
+    self.max_queue = max_queue
+    self.policy = policy
+    self.subsample = subsample
+    self.credits = None
+
+    self.free = [buffer_type() for _ in range(max_queue + 1)]
+    self.buffer = buffer_type()
+    self.queue = deque()
+    self.busy = False
+    self.cond = threading.Condition()
+
+    self.count = 0
+    self.dropped = 0  # evicted from the queue before being sent
+    self.late = 0  # handed off while the sender was still busy
+    self.throttled = 0  # skipped for lack of credit
+
+    self.thread = threading.Thread(target=self._run, name='ExperienceDumper', daemon=True)
+    self.thread.start()
+
+  def reset_buffers(self, buffer_type):
+    "Switches to a different buffer type. Only valid before the first hand_off."
+    with self.cond:
+      assert self.count == 0
+      self.free = [buffer_type() for _ in range(self.max_queue + 1)]
+      self.buffer = buffer_type()
+
+  def hand_off(self, **meta):
+    "Queues the current buffer for sending and swaps in an empty one."
+    with self.cond:
+      self.count += 1
+
+      if self.busy or self.queue:
+        self.late += 1
+
+      self.queue.append((self.buffer, meta))
+
+      if self.free:
+        self.buffer = self.free.pop()
+      else:
+        self.buffer, _ = self.queue.popleft()
+        self.dropped += 1
+
+      self.cond.notify()
+
+  def grant(self, credits):
+    "Replaces our remaining credit with a new grant from the trainer."
+    if self.policy == 'none':
+      return
+
+    with self.cond:
+      self.credits = credits
+      self.cond.notify()
+
+  def _ready(self):
+    if not self.queue:
+      return False
+    return self.policy != 'buffer' or self.credits != 0
+
+  def _credited(self):
+    if self.credits is None:
+      return True
+    if self.credits > 0:
+      self.credits -= 1
+      return True
+    return self.policy == 'subsample' and random.random() < self.subsample
+
+  def _run(self):
+    while True:
+      with self.cond:
+        if not self._ready():
+          self.cond.wait(self.interval)
+
+        if not self._ready():
+          buffer = None
+        else:
+          buffer, meta = self.queue.popleft()
+
+          if not self._credited():
+            self.throttled += 1
+            self.free.append(buffer)
+            continue
+
+          self.busy = True
+
+      if buffer is None:
+        # timed out (or woken) with nothing to send
+        if self.idle:
+          try:
+            self.idle()
+          except Exception:
+            traceback.print_exc()
+        continue
+
+      try:
+        prepared = self.prepare(buffer, **meta)
+      except Exception:
+        traceback.print_exc()
+        prepared = None
+
+      with self.cond:
+        self.free.append(buffer)
+        self.busy = False
+
+      if prepared is None:
+        continue
+
+      try:
+        self.send(prepared)
+      except Exception:
+        traceback.print_exc()
@@ -1,6 +1,6 @@
 from phillip.RL import RL
 import tensorflow as tf
-from . import ssbm, util, ctype_util as ct, embed
+from . import ssbm, util, ctype_util as ct, embed, schema, batch
 from .core import Core
 from .ac import ActorCritic
 from .critic import Critic
@@ -8,6 +8,10 @@ from phillip import tf_lib as tfl
 from .mutators import relative
 from .default import Option
 import os
+import time
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 class Learner(RL):
   
@@ -30,6 +34,8 @@ class Learner(RL):
     Option('batch_size', type=int),
     Option('neg_reward_scale', type=float, default=1., help="scale down negative rewards for more optimism"),
     Option('unpredict_weight', type=float, default=0., help="regress delayed actions (computed with prediction) to the undelayed ones (computed on true states)"),
+    Option('summary_interval', type=float, default=0., help="minimum number of seconds between summaries, on top of the caller's log argument"),
+    Option('stage_batches', type=int, default=0, help="copy each batch into the graph once for all batch_steps, staging the next one while training"),
   ]
 
   def __init__(self, debug=False, **kwargs):
@@ -56,14 +62,26 @@ class Learner(RL):
         self.critic = Critic(self.core.output_size, **kwargs)
 
       # experience = trajectory. usually a list of SimpleStateAction's. 
-      self.experience = ct.inputCType(ssbm.SimpleStateAction, [None, self.config.experience_length], "experience")
+      # manipulating time along the first axis is much more efficient, so we
+      # take batches time-major (see batch.py)
+      self.experience = ct.inputCType(ssbm.SimpleStateAction, [self.config.experience_length, None], "experience")
       # instantaneous rewards for all but the last state
-      self.experience['reward'] = tf.placeholder(tf.float32, [None, self.config.experience_length-1], name='experience/reward')
-      # manipulating time along the first axis is much more efficient
-      experience = util.deepMap(tf.transpose, self.experience)       
+      self.experience['reward'] = tf.placeholder(tf.float32, [self.config.experience_length-1, None], name='experience/reward')
       # initial state for recurrent networks
       self.experience['initial'] = tuple(tf.placeholder(tf.float32, [None, size], name='experience/initial/%d' % i) for i, size in enumerate(self.core.hidden_size))
-      experience['initial'] = self.experience['initial']
+      # per-trajectory importance sampling weights, for prioritized replay
+      if self.stage_batches:
+        # staged along with the batch, so always fed
+        self.weights = tf.placeholder(tf.float32, [None], name='experience/weights')
+      else:
+        self.weights = tf.placeholder_with_default(tf.ones_like(self.experience['reward'][0]), [None], name='experience/weights')
+      # what we actually feed; experiences may be projected down to this
+      self.feed_experience = schema.project(self.experience, schema.fields(self.embedGame))
+
+      if self.stage_batches:
+        experience, weights = self._init_staging()
+      else:
+        experience, weights = self.experience, self.weights
 
       states = self.embedGame(experience['state'])
       prev_actions = self.embedAction(experience['prev_action'])
@@ -82,7 +100,7 @@ class Learner(RL):
         def f(prev, current_input):
           _, prev_state = prev
           return self.core.core(current_input, prev_state)
-        batch_size = tf.shape(self.experience['reward'])[0]
+        batch_size = tf.shape(experience['reward'])[1]
         dummy_output = tf.zeros(tf.stack([batch_size, tf.constant(self.core.output_size)]))
         scan_fn = tf.scan if self.dynamic else tfl.scan
         core_outputs, hidden_states = scan_fn(f, inputs, (dummy_output, experience['initial']))
@@ -97,6 +115,8 @@ class Learner(RL):
       train_ops = []
       losses = []
       loss_vars = []
+      # only defined when there is a critic, see below
+      self.priorities = None
 
       if self.train_model or self.predict:
         model_loss, predicted_core_outputs = self.model.train(history, core_outputs, hidden_states, actions, experience['state'])
@@ -151,14 +171,16 @@ class Learner(RL):
         shifted_core_outputs = core_outputs[:delay_length] if self.unshift_critic else core_outputs[delay:]
         delayed_rewards = rewards[delay:]
         delayed_rewards = tf.nn.relu(delayed_rewards) - self.neg_reward_scale * tf.nn.relu(-delayed_rewards)
-        critic_loss, targets, advantages = self.critic(shifted_core_outputs, rewards[delay:], prob_ratios[:-1])
+        critic_loss, targets, advantages = self.critic(shifted_core_outputs, rewards[delay:], prob_ratios[:-1], weights=weights)
+        # how much there is to learn from each trajectory
+        self.priorities = tf.reduce_mean(tf.abs(advantages), 0)
       
       if self.train_critic:
         losses.append(critic_loss)
         loss_vars.extend(self.critic.variables)
       
       if self.train_policy:
-        policy_loss = self.policy.train(train_log_probs[:-1], advantages, entropy[:-1])
+        policy_loss = self.policy.train(train_log_probs[:-1], advantages, entropy[:-1], weights=weights)
         losses.append(policy_loss)
         loss_vars.extend(self.policy.getVariables())
         
@@ -191,6 +213,17 @@ class Learner(RL):
         train_op = optimizer.apply_gradients(zip(capped_gs, vs))
         train_ops.append(train_op)
       
+      # variables that actors don't have, so needn't be sent to them
+      learner_only = optimizer.variables()
+      if self.train_policy or self.train_critic:
+        learner_only += self.critic.variables
+      if (self.train_model or self.explore_scale) and not self.predict:
+        learner_only += self.model.getVariables()
+      if self.evolve_learning_rate:
+        learner_only.append(self.learning_rate)
+      if self.explore_scale and self.evolve_explore_scale:
+        learner_only.append(self.explore_scale)
+      
       print("Created train op(s)")
       
       avg_reward, _ = tfl.stats(experience['reward'], 'reward')
@@ -202,6 +235,7 @@ class Learner(RL):
       
       if self.pop_id >= 0:
         self.reward = tf.Variable(0., trainable=False, name='avg_reward')
+        learner_only.append(self.reward)
         tf.summary.scalar('avg_reward', self.reward)
         new_reward = (1. - self.reward_decay) * self.reward + self.reward_decay * avg_reward
         misc_ops.append(tf.assign(self.reward, new_reward))
@@ -219,20 +253,115 @@ class Learner(RL):
       print("Creating summary writer at logs/%s." % self.name)
       #self.writer = tf.summary.FileWriter('logs/' + self.name)#, self.graph)
       self.writer = tf.summary.FileWriter(self.path)
+      # serializing and writing summaries stays off the training thread
+      self.summary_writer = ThreadPoolExecutor(1)
+      self.last_summary = 0.
+      # how much longer steps take when they also fetch summaries
+      self.step_time = util.MovingAverage(.1)
+      self.summary_time = 0.
 
       self._finalize_setup()
 
+      learner_only = set(v.name for v in learner_only)
+      self.actor_variables = [v for v in self.variables if v.name not in learner_only]
+
+    if self.stage_batches:
+      self.sess.run(self.stage_init)
+      # one batch at a time, in order
+      self.stager = ThreadPoolExecutor(1)
+      self.staged = deque()
+
+  def _init_staging(self):
+    """Builds the graph-resident copy of a batch that training reads from.
+
+    Batches are put into a staging area (on the device) by stage_batch, then
+    moved into local variables by stage_load, which are read for as many steps
+    as we like without feeding anything.
+
+    Returns:
+      The staged experience and weights, in place of the placeholders.
+    """
+    feeds = []
+    for p in util.deepValues(self.feed_experience):
+      feeds.extend(p if isinstance(p, tuple) else [p])
+    feeds.append(self.weights)
+
+    area = tf.contrib.staging.StagingArea([p.dtype for p in feeds], capacity=1)
+    self.stage_put = area.put(feeds)
+
+    staged_vars = []
+    staged = {}
+    for i, p in enumerate(feeds):
+      # batch sizes vary, so don't fix the shape
+      v = tf.Variable(tf.zeros([0] * p.get_shape().ndims, p.dtype), validate_shape=False,
+                      trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name='staged/%d' % i)
+      staged_vars.append(v)
+      t = tf.identity(v)
+      t.set_shape(p.get_shape())
+      staged[p] = t
+
+    self.stage_load = tf.group(*[tf.assign(v, x, validate_shape=False) for v, x in zip(staged_vars, area.get())])
+    self.stage_init = tf.variables_initializer(staged_vars)
+
+    experience = util.deepMap(lambda p: staged.get(p, p), self.experience)
+    return experience, staged[self.weights]
+
+  def feed_dict(self, experiences, weights=None, zipped=False, time_major=False):
+    """Maps the placeholders to a batch of experiences.
+
+    Args:
+      experiences: A list of trajectories, or if zipped, a batch of them
+        stacked along a leading axis, or if time_major, a batch.time_major one.
+    """
+    if not time_major:
+      if not zipped:
+        experiences = util.deepZipWith(lambda *xs: np.stack(xs), *experiences)
+      experiences = batch.time_major(experiences)
+    
+    input_dict = dict(util.deepValues(util.deepZip(self.feed_experience, experiences)))
+    # widen any narrowed fields
+    input_dict = {p: np.asarray(v, dtype=p.dtype.as_numpy_dtype) for p, v in input_dict.items()}
+    if weights is not None:
+      input_dict[self.weights] = weights
+    elif self.stage_batches:
+      input_dict[self.weights] = np.ones(batch.size(experiences), dtype=np.float32)
+    return input_dict
+
+  def stage_batch(self, experiences, weights=None, **kwargs):
+    """Starts copying a batch into the graph, in the background.
+
+    Staged batches are trained on in order by train(None, ...). As the staging
+    area holds a single batch, this overlaps with training on the previous one.
+    """
+    input_dict = self.feed_dict(experiences, weights, **kwargs)
+    self.staged.append(self.stager.submit(self.sess.run, self.stage_put, input_dict))
+
   def train(self, experiences,
             batch_steps=1,
             train=True,
             log=True,
             zipped=False,
             retrieve_kls=False, 
+            retrieve_priorities=False,
+            weights=None,
+            time_major=False,
             **kwargs):
-    if not zipped:
-      experiences = util.deepZip(*experiences)
+    """Trains on a batch of experiences.
     
-    input_dict = dict(util.deepValues(util.deepZip(self.experience, experiences)))
+    Args:
+      experiences: A list of trajectories, or if zipped, a batch of them
+        stacked along a leading axis, or if time_major, a batch.time_major one.
+        When staging, None trains on the oldest batch from stage_batch.
+    """
+    if self.stage_batches:
+      if experiences is not None:
+        self.stage_batch(experiences, weights, zipped=zipped, time_major=time_major)
+      # wait for the put, then move the batch into place once for all steps
+      self.staged.popleft().result()
+      self.sess.run(self.stage_load)
+      input_dict = {}
+    else:
+      input_dict = self.feed_dict(experiences, weights, zipped=zipped, time_major=time_major)
     
     """
     saved_data = self.sess.run(self.saved_data, input_dict)
@@ -252,6 +381,11 @@ class Learner(RL):
     if retrieve_kls:
       run_dict.update(kls=self.kls)
     
+    if retrieve_priorities:
+      if self.priorities is None:
+        raise ValueError("Priorities need a critic (train_policy or train_critic).")
+      run_dict.update(priorities=self.priorities)
+    
     if self.profile:
       run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
       run_metadata = tf.RunMetadata()
@@ -261,15 +395,25 @@ class Learner(RL):
       run_options = None
       run_metadata = None
 
+    # summaries are fetched along with the last step, when due
     if log:
-      run_dict.update(summary=self.summarize)
+      now = time.time()
+      log = now - self.last_summary >= self.summary_interval
+      if log:
+        self.last_summary = now
     
     outputs = []
+    self.summary_time = 0.
     
-    for _ in range(batch_steps):
+    for i in range(batch_steps):
+      summarize = log and i == batch_steps - 1
+      if summarize:
+        run_dict.update(summary=self.summarize)
       try:
+        start = time.time()
         results = self.sess.run(run_dict, input_dict,
             options=run_options, run_metadata=run_metadata)
+        elapsed = time.time() - start
       except tf.errors.InvalidArgumentError as e:
         import pickle
         with open(os.path.join(self.path, 'error_frame'), 'wb') as f:
@@ -277,11 +421,16 @@ class Learner(RL):
         raise e
       #print('After run: %s' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
       
+      if summarize:
+        self.summary_time = max(elapsed - self.step_time.avg, 0.)
+      else:
+        self.step_time.append(elapsed)
+      
       outputs.append(results)
       global_step = results['global_step']
-      if log:
-        summary_str = results['summary']
-        self.writer.add_summary(summary_str, global_step)
+      if 'summary' in results:
+        # parsing and writing the summary stays off the training thread
+        self.summary_writer.submit(self.writer.add_summary, results.pop('summary'), global_step)
       if self.profile:
         # Create the Timeline object, and write it to a json
         from tensorflow.python.client import timeline
@@ -0,0 +1,171 @@
+"""
+Wire format for parameter broadcasts.
+
+Each message has a small fixed-size header followed by the (optionally
+compressed) pickled body. Keyframes carry every variable, in float32, float16 or
+bfloat16. Between keyframes the trainer can send deltas: the change in each
+float variable since the last broadcast, quantized to int8 with a per-variable
+scale. The header carries the message's version and, for deltas, the version
+they apply to, so a receiver that missed one waits for the next keyframe.
+Credit advertisements (see Trainer.credit) ride in the header as well.
+"""
+
+import pickle
+import struct
+from collections import namedtuple
+import numpy as np
+from .codec import compressors, decompressors
+from .default import Default, Option
+
+MAGIC = b'PP'
+VERSION = 1
+
+# magic, format version, kind, dtype, compression, version, base, global_step, credit
+_header = struct.Struct('<2sBBBBqqqi')
+HEADER_SIZE = _header.size
+
+Header = namedtuple('Header', ['kind', 'dtype', 'compression', 'version', 'base', 'global_step', 'credit'])
+
+# message kinds
+KEYFRAME = 0
+DELTA = 1
+CREDIT = 2  # header only
+
+NO_CREDIT = -1
+
+# bfloat16 is the top half of a float32, which numpy has no type for
+
+def to_bfloat16(x):
+  bits = np.ascontiguousarray(x, dtype=np.float32).view(np.uint32)
+  # round to nearest even
+  bits = bits + np.uint32(0x7FFF) + ((bits >> 16) & 1)
+  return (bits >> 16).astype(np.uint16)
+
+def from_bfloat16(x):
+  return (x.astype(np.uint32) << 16).view(np.float32)
+
+# id, encode, decode
+dtypes = dict(
+  float32 = (0, lambda x: x.astype(np.float32), lambda x: x),
+  float16 = (1, lambda x: x.astype(np.float16), lambda x: x.astype(np.float32)),
+  bfloat16 = (2, to_bfloat16, from_bfloat16),
+)
+
+dtype_decoders = {id_: decode for id_, _, decode in dtypes.values()}
+
+def quantize(delta):
+  "int8 quantization of a delta, with its scale."
+  scale = np.abs(delta).max() / 127.
+  if scale == 0.:
+    return np.zeros(delta.shape, dtype=np.int8), np.float32(0.)
+  return np.round(delta / scale).astype(np.int8), np.float32(scale)
+
+def dequantize(quantized, scale):
+  return quantized.astype(np.float32) * scale
+
+class Encoder(Default):
+  _options = [
+    Option('params_dtype', type=str, default='float32', choices=dtypes.keys(), help="precision of the float parameters in keyframes"),
+    Option('params_delta', type=int, default=0, help="send int8 deltas between keyframes"),
+    Option('keyframe_interval', type=int, default=10, help="with --params_delta, broadcasts between full keyframes"),
+    Option('params_compress', type=str, default='none', choices=compressors.keys(), help="compression for parameter broadcasts"),
+  ]
+
+  def __init__(self, **kwargs):
+    Default.__init__(self, **kwargs)
+
+    self.version = 0
+    # what receivers have, so that quantization errors don't accumulate
+    self.reference = None
+
+  def encode(self, params, global_step, credit=None):
+    """Serializes the next broadcast.
+
+    Args:
+      params: A dict from variable name to value, as from RL.blob.
+      global_step: The trainer's global step.
+      credit: Experience credit to advertise, if any.
+    Returns:
+      The encoded message, as bytes.
+    """
+    self.version += 1
+    keyframe = not self.params_delta or self.reference is None or self.version % self.keyframe_interval == 0
+
+    # floats are what we compress; anything else (e.g. global_step) goes as is
+    floats = {k: v for k, v in params.items() if v.dtype.kind == 'f'}
+    others = {k: v for k, v in params.items() if v.dtype.kind != 'f'}
+
+    if keyframe:
+      kind, base = KEYFRAME, 0
+      dtype, encode, decode = dtypes[self.params_dtype]
+      floats = {k: encode(v) for k, v in floats.items()}
+      self.reference = {k: decode(v) for k, v in floats.items()}
+    else:
+      kind, base = DELTA, self.version - 1
+      dtype = dtypes['float32'][0]
+      for k, v in floats.items():
+        quantized, scale = quantize(v - self.reference[k])
+        self.reference[k] = self.reference[k] + dequantize(quantized, scale)
+        floats[k] = quantized, scale
+
+    body = floats, others
+    return self._pack(kind, dtype, body, base, global_step, credit)
+
+  def _pack(self, kind, dtype, body, base, global_step, credit):
+    compression, compress, _ = compressors[self.params_compress]
+    body = compress(pickle.dumps(body, pickle.HIGHEST_PROTOCOL), 6)
+    header = _header.pack(MAGIC, VERSION, kind, dtype, compression,
+                          self.version, base, global_step, NO_CREDIT if credit is None else credit)
+    return header + body
+
+def encode_credit(credit):
+  "A message that only advertises credit."
+  return _header.pack(MAGIC, VERSION, CREDIT, 0, 0, 0, 0, 0, credit)
+
+def read_header(blob):
+  """Reads only the header of a message.
+
+  Returns None for legacy (plain pickle) messages.
+  """
+  if blob[:len(MAGIC)] != MAGIC:
+    return None
+
+  magic, version, *fields = _header.unpack_from(blob)
+  if version != VERSION:
+    raise ValueError("Unsupported params version %d" % version)
+  return Header(*fields)
+
+class Decoder(object):
+  "Reconstructs parameters from a stream of broadcasts."
+
+  def __init__(self):
+    self.version = None
+    self.values = None
+
+  def decode(self, header, blob):
+    """Applies a message.
+
+    Returns:
+      The full parameters as of this message, or None if we can't tell them
+      (a delta against a version we don't have) or it carries none.
+    """
+    if header.kind == CREDIT:
+      return None
+    if header.kind == DELTA and header.base != self.version:
+      # wait for the next keyframe
+      self.version = None
+      return None
+
+    body = memoryview(blob)[HEADER_SIZE:]
+    floats, others = pickle.loads(decompressors[header.compression](body))
+
+    if header.kind == KEYFRAME:
+      decode = dtype_decoders[header.dtype]
+      values = {k: decode(v) for k, v in floats.items()}
+    else:
+      values = {k: self.values[k] + dequantize(*v) for k, v in floats.items()}
+    values.update(others)
+    self.values = values
+
+    self.version = header.version
+    return self.values
@@ -0,0 +1,183 @@
+"""
+Experience replay for the trainer.
+"""
+
+import numpy as np
+from . import util, batch
+
+class SumTree(object):
+  """Array-based binary tree of priorities, for proportional sampling.
+
+  Leaves hold the priorities and each internal node the sum of its children,
+  with the root at index 1. Updates and samples take O(log N), and are
+  vectorized over batches of indices.
+  """
+
+  def __init__(self, capacity):
+    self.size = 1
+    while self.size < capacity:
+      self.size *= 2
+    self.tree = np.zeros(2 * self.size, dtype=np.float64)
+
+  def total(self):
+    return self.tree[1]
+
+  def get(self, indices):
+    return self.tree[self.size + np.asarray(indices)]
+
+  def update(self, indices, priorities):
+    nodes = self.size + np.asarray(indices)
+    self.tree[nodes] = priorities
+    while nodes[0] > 1:
+      nodes = np.unique(nodes // 2)
+      self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+  def find(self, values):
+    "Indices of the leaves where the given cumulative sums fall."
+    values = np.array(values, dtype=np.float64)
+    nodes = np.ones(len(values), dtype=np.int64)
+    while nodes[0] < self.size:
+      left = 2 * nodes
+      right = values > self.tree[left]
+      values -= right * self.tree[left]
+      nodes = left + right
+    return nodes - self.size
+
+  def sample(self, size, rng):
+    "Samples indices proportionally to priority, stratified over the total."
+    bounds = np.linspace(0., self.total(), size + 1)
+    values = rng.uniform(bounds[:-1], bounds[1:])
+    return self.find(values)
+
+class ReplayBuffer(object):
+  """Fixed-capacity ring buffer of trajectories in preallocated columns.
+
+  Columns are allocated when the first batch is added, in the same time-major
+  layout as batches, and new trajectories overwrite the oldest ones. Trajectories
+  are evicted early once they're more than max_age steps old, more than
+  max_kl off-policy (as of the last time we trained on them), or have been
+  trained on reuse times.
+
+  With alpha > 0, trajectories are sampled proportionally to their priority
+  to the power alpha, where priorities are supplied after training on them
+  (new ones get the highest priority seen so far). Importance sampling
+  weights, with exponent beta, then correct for the bias.
+  """
+
+  def __init__(self, capacity, max_age=None, max_kl=None, reuse=1, alpha=0., beta=0.4, seed=None):
+    self.capacity = capacity
+    self.max_age = max_age
+    self.max_kl = max_kl
+    self.reuse = reuse
+    self.alpha = alpha
+    self.beta = beta
+    self.rng = np.random.RandomState(seed)
+
+    if alpha:
+      self.priorities = SumTree(capacity)
+      self.max_priority = 1.
+
+    self.columns = None
+    self.next = 0
+
+    self.valid = np.zeros(capacity, dtype=bool)
+    self.steps = np.zeros(capacity, dtype=np.int64)
+    self.uses = np.zeros(capacity, dtype=np.int64)
+    self.kls = np.zeros(capacity, dtype=np.float32)
+
+    # eviction counts, by reason
+    self.evicted = dict(overwritten=0, age=0, kl=0, reuse=0)
+
+  def __len__(self):
+    return int(self.valid.sum())
+
+  def _allocate(self, experiences):
+    def allocate(x, axis):
+      shape = list(x.shape)
+      shape[axis] = self.capacity
+      return np.zeros(shape, dtype=x.dtype)
+    self.columns = batch.map_fields(allocate, experiences)
+
+  def add(self, experiences):
+    "Adds a time-major batch of trajectories, overwriting the oldest."
+    if self.columns is None:
+      self._allocate(experiences)
+
+    size = batch.size(experiences)
+    indices = (self.next + np.arange(size)) % self.capacity
+    self.next = (self.next + size) % self.capacity
+
+    for k, v in experiences.items():
+      if batch.batch_axis(k):
+        def write(column, x):
+          column[:, indices] = x
+      else:
+        def write(column, x):
+          column[indices] = x
+      util.deepZipWith(write, self.columns[k], v)
+
+    self.evicted['overwritten'] += int(self.valid[indices].sum())
+    self.valid[indices] = True
+    self.steps[indices] = experiences['global_step']
+    self.uses[indices] = 0
+    self.kls[indices] = 0.
+
+    if self.alpha:
+      self.priorities.update(indices, self.max_priority ** self.alpha)
+
+  def _evict(self, mask, reason):
+    mask &= self.valid
+    self.evicted[reason] += int(mask.sum())
+    self.valid &= ~mask
+
+    if self.alpha and mask.any():
+      self.priorities.update(np.flatnonzero(mask), 0.)
+
+  def evict(self, global_step):
+    "Evicts trajectories that are too old, too off-policy or used up."
+    if self.max_age is not None:
+      self._evict(self.steps < global_step - self.max_age, 'age')
+    if self.max_kl is not None:
+      self._evict(self.kls > self.max_kl, 'kl')
+    self._evict(self.uses >= self.reuse, 'reuse')
+
+  def sample(self, size):
+    """Picks trajectories to train on.
+
+    Without prioritization, picks up to size distinct trajectories uniformly.
+
+    Returns:
+      The buffer indices of the trajectories, the stacked trajectories, and
+      their importance sampling weights (None if sampling uniformly).
+    """
+    if not self.alpha:
+      valid = np.flatnonzero(self.valid)
+      indices = self.rng.choice(valid, min(size, len(valid)), replace=False)
+      return indices, self.get(indices), None
+
+    indices = self.priorities.sample(size, self.rng)
+    probs = self.priorities.get(indices) / self.priorities.total()
+    weights = (len(self) * probs) ** -self.beta
+    weights /= weights.max()
+    return indices, self.get(indices), weights.astype(np.float32)
+
+  def get(self, indices):
+    return batch.take(self.columns, indices)
+
+  def update(self, indices, kls, priorities=None):
+    """Records that we trained on some trajectories.
+
+    Args:
+      indices: As returned by sample.
+      kls: The trajectories' KLs at the time.
+      priorities: New priorities for the trajectories, if prioritizing.
+    """
+    np.add.at(self.uses, indices, 1)
+    self.kls[indices] = kls
+
+    if self.alpha:
+      priorities = np.asarray(priorities, dtype=np.float64) + 1e-6
+      self.max_priority = max(self.max_priority, priorities.max())
+      # trajectories may have been evicted since they were sampled
+      priorities = np.where(self.valid[indices], priorities ** self.alpha, 0.)
+      self.priorities.update(indices, priorities)
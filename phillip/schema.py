@@ -0,0 +1,98 @@
+"""
+Projection of dumped experience onto the fields that training reads.
+
+Dumps would otherwise carry every GameMemory field (cursors, controllers,
+menus, ...), most of which the embedding never looks at. The kept fields are
+derived from the GameEmbedding in use, plus those needed for rewards and the
+experience catalog, and integer fields are narrowed to the smallest dtype that
+holds them. Learner.train widens them again when feeding its placeholders.
+"""
+
+import numpy as np
+from . import embed
+
+# read by reward.rewards_np and catalog.describe, whatever the embedding
+player_fields = ['action_state', 'percent', 'character']
+game_fields = ['stage']
+
+# per-frame fields and everything else an experience carries
+top_fields = ['prev_action', 'action', 'prob', 'reward', 'initial', 'global_step']
+
+narrow_dtypes = {
+  'action_state': np.uint16,  # up to embed.maxAction
+  'percent': np.uint16,  # can go past 255
+  'stock': np.uint8,
+  'character': np.uint8,
+  'jumps_used': np.uint8,
+  'stage': np.uint8,
+  'prev_action': np.uint16,
+  'action': np.uint16,
+}
+
+def used_fields(embedding):
+  """The part of a structure that an embedding reads.
+
+  Returns:
+    Nested dicts keyed by field name (or array index), with True leaves.
+  """
+  if isinstance(embedding, embed.FCEmbedding):
+    return used_fields(embedding.wrapper)
+  if isinstance(embedding, embed.StructEmbedding):
+    return {field: used_fields(op) for field, op in embedding.embedding if op is not embed.nullEmbedding}
+  if isinstance(embedding, embed.ArrayEmbedding):
+    return {i: used_fields(embedding.op) for i in embedding.permutation}
+  return True
+
+def fields(embedGame):
+  "The experience fields that training with embedGame needs."
+  state = used_fields(embedGame)
+  players = state.setdefault('players', {})
+  for p in [0, 1]:
+    players.setdefault(p, {}).update({f: True for f in player_fields})
+  state.update({f: True for f in game_fields})
+
+  experience = {f: True for f in top_fields}
+  experience['state'] = state
+  return experience
+
+def project(obj, fields):
+  "Keeps only the parts of obj in fields. Works on placeholders too."
+  if fields is True:
+    return obj
+  if isinstance(obj, dict):
+    return {k: project(obj[k], f) for k, f in fields.items() if k in obj}
+  if isinstance(obj, list):
+    return [project(x, fields.get(i, {})) for i, x in enumerate(obj)]
+  return obj
+
+def narrow(obj, name=None):
+  "Casts integer fields of a (projected) experience to compact dtypes."
+  if isinstance(obj, dict):
+    return {k: narrow(v, k) for k, v in obj.items()}
+  if isinstance(obj, list):
+    return [narrow(x, name) for x in obj]
+  dtype = narrow_dtypes.get(name)
+  if dtype is not None and isinstance(obj, np.ndarray):
+    return obj.astype(dtype)
+  return obj
+
+# what differs between the two agents playing the same game
+perspective_fields = ['prev_action', 'action', 'prob', 'initial', 'global_step']
+
+def unpair(paired):
+  """Materializes both perspectives of a paired dump.
+
+  The game states and rewards are stored from the first agent's perspective;
+  the second agent sees the players in the opposite order and the opposite
+  reward.
+  """
+  state = paired['state']
+  states = [state, dict(state, players=state['players'][::-1])]
+  rewards = [paired['reward'], -paired['reward']]
+
+  experiences = []
+  for i in range(2):
+    experience = {f: paired[f][i] for f in perspective_fields}
+    experience.update(state=states[i], reward=rewards[i])
+    experiences.append(experience)
+  return experiences
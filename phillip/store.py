@@ -0,0 +1,261 @@
+"""
+Append-only, sharded storage for experience dumps.
+
+Each writer appends encoded trajectories to a segment file. Once a segment
+reaches its size cap it is sealed: an index of record offsets and a fixed-size
+trailer are appended and the file is atomically renamed from NAME.seg.open to
+NAME.seg. Readers only ever look at sealed segments, which they memory-map.
+
+Segment layout:
+  [length][record] [length][record] ... [index] [trailer]
+where length is a uint64, index is a [count, 2] uint64 array of (offset, length)
+pairs pointing at the records, and trailer is (magic, count, index offset).
+"""
+
+import os
+import glob
+import mmap
+import fcntl
+import struct
+import time
+import queue
+import threading
+import traceback
+import numpy as np
+
+SUFFIX = '.seg'
+OPEN_SUFFIX = '.open'
+
+MAGIC = b'PHSEG\x00\x00\x01'
+_trailer = struct.Struct('<8sQQ')
+_length = struct.Struct('<Q')
+
+def _write_footer(f, index):
+  index_offset = f.tell()
+  f.write(np.array(index, dtype=np.uint64).reshape([-1, 2]).tobytes())
+  f.write(_trailer.pack(MAGIC, len(index), index_offset))
+  f.flush()
+  os.fsync(f.fileno())
+
+class SegmentWriter(object):
+  """Appends records to rolling segments, capped in size and age. Thread-safe.
+
+  A segment is sealed once it reaches max_size bytes, or on the first append
+  after it's max_age seconds old, so that readers see slow writers' data.
+  """
+
+  def __init__(self, directory, tag, max_size=64 * 2**20, max_age=None):
+    self.directory = directory
+    self.tag = tag
+    self.max_size = max_size
+    self.max_age = max_age
+    self.segment = 0
+    self.file = None
+    self.lock = threading.Lock()
+
+  def _open(self):
+    self.name = '%s_%d%s' % (self.tag, self.segment, SUFFIX)
+    self.path = os.path.join(self.directory, self.name)
+    self.file = open(self.path + OPEN_SUFFIX, 'wb')
+    self.opened = time.time()
+    # held until we close the file (or die), so recover can tell we're alive
+    fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    self.index = []
+
+  def _seal(self):
+    _write_footer(self.file, self.index)
+    self.file.close()
+    self.file = None
+    os.rename(self.path + OPEN_SUFFIX, self.path)
+    self.segment += 1
+
+  def append(self, blob):
+    """Appends a record.
+
+    Returns:
+      The (segment name, offset, length) of the record.
+    """
+    with self.lock:
+      if self.file is None:
+        self._open()
+
+      self.file.write(_length.pack(len(blob)))
+      offset = self.file.tell()
+      self.file.write(blob)
+      self.index.append((offset, len(blob)))
+      location = (self.name, offset, len(blob))
+
+      if self.file.tell() >= self.max_size:
+        self._seal()
+      elif self.max_age is not None and time.time() - self.opened >= self.max_age:
+        self._seal()
+
+      return location
+
+  def close(self):
+    "Seals the current segment, if any."
+    with self.lock:
+      if self.file is not None:
+        self._seal()
+
+class Segment(object):
+  """Read-only, memory-mapped view of a sealed segment.
+
+  Records are returned as memoryviews into the map, without copying.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.name = os.path.basename(path)
+
+    with open(path, 'rb') as f:
+      self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, count, index_offset = _trailer.unpack_from(self.mmap, len(self.mmap) - _trailer.size)
+    if magic != MAGIC:
+      raise ValueError("%s is not a sealed segment" % path)
+
+    index = np.frombuffer(self.mmap, dtype=np.uint64, count=2*count, offset=index_offset)
+    self.index = index.reshape([count, 2]).astype(np.int64)
+    self.view = memoryview(self.mmap)
+
+  def __len__(self):
+    return len(self.index)
+
+  def __getitem__(self, i):
+    offset, length = self.index[i]
+    return self.view[offset:offset+length]
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+  def record_at(self, offset, length):
+    return self.view[offset:offset+length]
+
+def list_segments(directory):
+  "Sealed segments in a directory, in name order."
+  return sorted(glob.glob(os.path.join(directory, '*' + SUFFIX)))
+
+def recover(open_path, min_age=300.):
+  """Seals a segment whose writer died before sealing it.
+
+  Any partially written trailing record is discarded. Segments whose writer
+  may still be alive are left alone: those whose lock is held (by a writer on
+  this machine) or that were modified within the last min_age seconds (by a
+  writer on any machine).
+
+  Returns:
+    The path of the sealed segment, or None if it was left alone.
+  """
+  assert open_path.endswith(OPEN_SUFFIX)
+
+  path = open_path[:-len(OPEN_SUFFIX)]
+
+  index = []
+  with open(open_path, 'r+b') as f:
+    try:
+      fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+      return None
+    if time.time() - os.fstat(f.fileno()).st_mtime < min_age:
+      return None
+
+    end = os.fstat(f.fileno()).st_size
+
+    # died between writing the footer and renaming
+    if end >= _trailer.size:
+      f.seek(end - _trailer.size)
+      if _trailer.unpack(f.read(_trailer.size))[0] == MAGIC:
+        os.rename(open_path, path)
+        return path
+
+    position = 0
+
+    while position + _length.size <= end:
+      f.seek(position)
+      length, = _length.unpack(f.read(_length.size))
+      offset = position + _length.size
+      if offset + length > end:
+        break
+      index.append((offset, length))
+      position = offset + length
+
+    f.seek(position)
+    f.truncate()
+    _write_footer(f, index)
+
+  os.rename(open_path, path)
+  return path
+
+def iter_records(path):
+  """Iterates over the records in a directory of dumps.
+
+  Handles both sealed segments and legacy one-file-per-trajectory dumps.
+  """
+  if os.path.isdir(path):
+    paths = sorted(glob.glob(os.path.join(path, '*')))
+  else:
+    paths = [path]
+
+  for p in paths:
+    if p.endswith(SUFFIX):
+      yield from Segment(p)
+    elif not p.endswith(OPEN_SUFFIX) and os.path.isfile(p):
+      with open(p, 'rb') as f:
+        yield f.read()
+
+class Tail(object):
+  """Follows a directory of segments, reading each one as soon as it's sealed.
+
+  Records are read on a background thread into a bounded queue, so a slow
+  consumer holds the reader back instead of piling up memory.
+  """
+
+  def __init__(self, directory, backlog=0, poll=1., max_queue=1024):
+    """
+    Args:
+      directory: Where writers seal their segments. Need not exist yet.
+      backlog: How many of the already sealed segments to read first, most
+        recently sealed last. -1 means all of them.
+      poll: Seconds between directory scans once we've caught up.
+      max_queue: Maximum number of records read ahead.
+    """
+    self.directory = directory
+    self.poll = poll
+    self.records = queue.Queue(max_queue)
+
+    existing = sorted(list_segments(directory), key=os.path.getmtime)
+    if backlog < 0:
+      backlog = len(existing)
+    self.seen = set(existing)
+    self.pending = existing[len(existing) - backlog:]
+
+    self.thread = threading.Thread(target=self._run, name='Tail', daemon=True)
+    self.thread.start()
+
+  def _run(self):
+    while True:
+      for path in self.pending:
+        try:
+          for record in Segment(path):
+            self.records.put(record)
+        except Exception:
+          # e.g. removed since we listed it, or corrupt; skip it
+          print("Failed to read segment", path)
+          traceback.print_exc()
+
+      time.sleep(self.poll)
+      try:
+        self.pending = [p for p in list_segments(self.directory) if p not in self.seen]
+      except Exception:
+        traceback.print_exc()
+        self.pending = []
+      self.seen.update(self.pending)
+
+  def recv(self, block=True, timeout=None):
+    "The next record, or None if there isn't one (within timeout)."
+    try:
+      return self.records.get(block, timeout)
+    except queue.Empty:
+      return None
@@ -482,9 +482,14 @@ def test_smoothed_returns():
 
   print("Passed test_smoothed_returns()")
 
-def restore(session, variables, ckpt_path):
-  """Does what a saver would do, but handles mismatched shapes."""
+def read_checkpoint(variables, ckpt_path):
+  """Reads the values of variables from a checkpoint, padding mismatched shapes.
+
+  Returns:
+    A dict from variable name to value, like RL.blob.
+  """
   ckpt = checkpoint_utils.load_checkpoint(ckpt_path)
+  values = {}
   
   for var in variables:
     name = var.name
@@ -496,5 +501,43 @@ def restore(session, variables, ckpt_path):
     if needs_pad:
       print("Variable %s of shape %s padded from %s" % (var.name, var.get_shape().as_list(), value.shape))
       value = np.pad(value, pads, "constant")
-    var.load(value, session)
+    values[var.name] = value
+  
+  return values
+
+def restore(session, variables, ckpt_path):
+  """Does what a saver would do, but handles mismatched shapes."""
+  values = read_checkpoint(variables, ckpt_path)
+  for var in variables:
+    var.load(values[var.name], session)
+
+class CheckpointWriter(object):
+  """Writes checkpoints from variable values already copied to host memory.
+
+  The variables are mirrored in a graph and session of our own, so writing
+  can happen on another thread without touching the original session.
+  """
 
+  def __init__(self, variables, max_to_keep=2):
+    self.graph = tf.Graph()
+    with self.graph.as_default(), tf.device('/cpu:0'):
+      self.placeholders = []
+      var_list = {}
+      for var in variables:
+        placeholder = tf.placeholder(var.dtype.base_dtype, var.get_shape())
+        self.placeholders.append(placeholder)
+        # loaded by running the initializers
+        var_list[var.op.name] = tf.Variable(placeholder, trainable=False, name=var.op.name)
+      self.initializers = [v.initializer for v in var_list.values()]
+      self.saver = tf.train.Saver(var_list, max_to_keep=max_to_keep, save_relative_paths=True)
+    self.graph.finalize()
+    self.sess = tf.Session(graph=self.graph)
+
+  def write(self, values, path, global_step):
+    """Writes path-global_step, then points the directory's checkpoint file at it.
+
+    Saver publishes the checkpoint file atomically, so readers that go
+    through tf.train.latest_checkpoint never see a partial write.
+    """
+    self.sess.run(self.initializers, dict(zip(self.placeholders, values)))
+    return self.saver.save(self.sess, path, global_step=global_step, write_meta_graph=False)
@@ -1,6 +1,6 @@
 import os, sys
 import time
-from phillip import learner, util, ssbm
+from phillip import learner, util, ssbm, schema, store, collector, replay, params
 from phillip.ac import ActorCritic
 from phillip.default import *
 import numpy as np
@@ -39,11 +39,22 @@ class Trainer(Default):
     Option("max_age", type=int, help="how old an experience can be before we discard it"),
     Option("max_kl", type=float, help="how off-policy an experience can be before we discard it"),
     Option("max_buffer", type=int, help="maximum size of experience buffer"),
+    Option("reuse", type=int, default=1, help="number of times to train on each experience in the buffer"),
+    Option("priority_alpha", type=float, default=0., help="prioritize replay by mean absolute advantage to this power; 0 samples uniformly"),
+    Option("priority_beta", type=float, default=0.4, help="importance sampling exponent for prioritized replay"),
     
     Option("log_interval", type=int, default=100),
     Option("dump", type=str, default="lo", help="interface to listen on for experience dumps"),
+    Option("tail", type=str, help="also train on segments sealed in this experience directory"),
+    Option("backlog", type=int, default=0, help="with --tail, number of already sealed segments to start from (-1 for all)"),
+    Option("decode_threads", type=int, default=2, help="number of threads decoding incoming experiences"),
+    Option("ready_batches", type=int, default=2, help="max batches collected ahead of training; older ones are dropped"),
     Option('send', type=int, default=1, help="send the network parameters on an nnpy PUB socket"),
+    Option("flow_control", type=int, default=0, help="advertise experience credits to actors on the params socket"),
+    Option("credit_scale", type=float, default=1.5, help="experiences to request per sweep, relative to batch_size"),
+    Option("credit_interval", type=float, default=1., help="seconds without experiences before re-advertising credits"),
     Option("save_interval", type=float, default=10, help="length of time between saves to disk, in minutes"),
+    Option("save_async", type=int, default=0, help="snapshot the variables and write them to disk in the background"),
 
     Option("load", type=str, help="path to a json file from which to load params"),
     Option("pop_size", type=int, default=0),
@@ -56,6 +67,7 @@ class Trainer(Default):
   
   _members = [
     ("learner", learner.Learner),
+    ("params_codec", params.Encoder),
   ]
   
   def __init__(self, load=None, **kwargs):
@@ -75,16 +87,29 @@ class Trainer(Default):
     with open(os.path.join(self.learner.path, 'ip'), 'w') as f:
       f.write(address)
 
+    # network actors can always connect, whether or not we also tail a directory
     self.experience_socket = nnpy.Socket(nnpy.AF_SP, nnpy.PULL)
     experience_addr = "tcp://%s:%d" % (address, util.port(self.learner.path + "/experience"))
     self.experience_socket.bind(experience_addr)
+    
+    receivers = [self.recv_experience]
+    if self.tail:
+      print("Tailing experiences in", self.tail)
+      self.experience_tail = store.Tail(self.tail, self.backlog)
+      receivers.append(self.experience_tail.recv)
 
     if self.send:
       self.params_socket = nnpy.Socket(nnpy.AF_SP, nnpy.PUB)
       params_addr = "tcp://%s:%d" % (address, util.port(self.learner.path + "/params"))
       print("Binding params socket to", params_addr)
       self.params_socket.bind(params_addr)
-
+    
+    if self.flow_control:
+      if not self.send:
+        sys.exit("Flow control needs --send 1")
+      # wake up periodically to re-advertise credits
+      self.experience_socket.setsockopt(nnpy.SOL_SOCKET, nnpy.RCVTIMEO, int(1000 * self.credit_interval))
+    
     self.sweep_size = self.batch_size
     print("Sweep size", self.sweep_size)
     
@@ -95,14 +120,27 @@ class Trainer(Default):
       self.learner.restore()
     
     self.last_save = time.time()
+    
+    self.replay = None
+    if self.priority_alpha and self.learner.priorities is None:
+      sys.exit("Prioritized replay needs a critic to get priorities from")
+    if self.max_buffer:
+      self.replay = replay.ReplayBuffer(
+        max(self.max_buffer, self.batch_size),
+        max_age=self.max_age, max_kl=self.max_kl, reuse=self.reuse,
+        alpha=self.priority_alpha, beta=self.priority_beta)
+    
+    self.collector = collector.Collector(
+      receivers, schema.fields(self.learner.embedGame), self.batch_size,
+      max_age=self.max_age, decode_threads=self.decode_threads, ready=self.ready_batches)
   
   def save(self):
     current_time = time.time()
     
     if current_time - self.last_save > 60 * self.save_interval:
       try:
-        self.learner.save()
-        self.last_save = current_time
+        if self.learner.save(block=not self.save_async):
+          self.last_save = current_time
       except tf.errors.InternalError as e:
         print(e, file=sys.stderr)
 
@@ -128,6 +166,49 @@ class Trainer(Default):
     self.learner.restore(latest_ckpt)
     return True
 
+  def credit(self, window=60):
+    "How many experiences each actor may send before the next advertisement."
+    active = self.collector.active(window)
+    return int(np.ceil(self.credit_scale * self.batch_size / max(active, 1)))
+
+  def advertise(self):
+    self.params_socket.send(params.encode_credit(self.credit()))
+
+  def recv_experience(self, block=True):
+    "The next experience message from the network, or None if not blocking and there isn't one."
+    while True:
+      try:
+        return self.experience_socket.recv(flags=0 if block else nnpy.DONTWAIT)
+      except nnpy.NNError as e:
+        if block and e.error_no == nnpy.ETIMEDOUT:
+          # actors may have run out of credit, e.g. if some have died
+          self.advertise()
+          continue
+        if not block and e.error_no == nnpy.EAGAIN:
+          return None
+        raise e
+
+  def next_batch(self, global_step):
+    "The next batch to train on, with its replay indices and importance weights."
+    if not self.replay:
+      return self.collector.get(), None, None
+
+    # only wait for new experiences if there's too little left to train on
+    self.replay.evict(global_step)
+    experiences = self.collector.get(block=len(self.replay) < self.batch_size)
+    while experiences is not None:
+      self.replay.add(experiences)
+      experiences = self.collector.get(block=False)
+    self.replay.evict(global_step)
+    indices, experiences, weights = self.replay.sample(self.batch_size)
+    return experiences, indices, weights
+
+  def stage_next(self, global_step):
+    "Stages the next batch in the learner, returning what we need after training on it."
+    experiences, indices, weights = self.next_batch(global_step)
+    self.learner.stage_batch(experiences, weights, time_major=True)
+    return experiences['global_step'], indices, weights
+
   def train(self):
     before = count_objects()
 
@@ -135,80 +216,55 @@ class Trainer(Default):
     step = 0
     global_step = self.learner.get_global_step()
     
-    times = ['min_collect', 'extra_collect', 'train', 'save']
+    self.collector.global_step = global_step
+    doa = 0
+    
+    times = ['collect', 'train', 'summary', 'save', 'stage']
     averages = {name: util.MovingAverage(.1) for name in times}
     
     timer = util.Timer()
     def split(name):
       averages[name].append(timer.split())
     
+    staged = None
+    if self.learner.stage_batches:
+      staged = self.stage_next(global_step)
+    
     while sweeps != self.sweep_limit:
       sweeps += 1
       timer.reset()
       
       #print('Start: %s' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
 
-      experiences = []
-      if self.max_age is not None:
-        age_limit = global_step - self.max_age
-        is_valid = lambda exp: exp['global_step'] >= age_limit
-        # experiences = list(filter(is_valid, experiences))
+      if self.learner.stage_batches:
+        # nothing is staged if training on the last batch failed
+        if staged is None:
+          staged = self.stage_next(global_step)
+        (steps, indices, weights), staged = staged, None
+        experiences = None
       else:
-        is_valid = lambda _: True
-      # dropped = old_len - len(experiences)
+        experiences, indices, weights = self.next_batch(global_step)
+        steps = experiences['global_step']
       
-      def pull_experience(block=True):
-        exp = self.experience_socket.recv(flags=0 if block else nnpy.DONTWAIT)
-        return pickle.loads(exp)
-
-      # to_collect = max(self.sweep_size - len(experiences), self.min_collect)
-      to_collect = self.batch_size
-      new_experiences = []
-
-      # print("Collecting experiences", len(experiences))
-      doa = 0 # dead on arrival
-      while len(new_experiences) < to_collect:
-        #print("Waiting for experience")
-        exp = pull_experience()
-        if is_valid(exp):
-          new_experiences.append(exp)
-        else:
-          #print("dead on arrival", doa)
-          doa += 1
-
-      split('min_collect')
-      #print('min_collected')
-
-      # pull in all the extra experiences
-      for _ in range(self.sweep_size):
-        try:
-          exp = pull_experience(False)
-          if is_valid(exp):
-            new_experiences.append(exp)
-          else:
-            doa += 1
-        except nnpy.NNError as e:
-          if e.error_no == nnpy.EAGAIN:
-            # nothing to receive
-            break
-          # a real error
-          raise e
-
-      # experiences += new_experiences
-      experiences = new_experiences[-self.batch_size:]
-      
-      ages = np.array([global_step - exp['global_step'] for exp in experiences])
+      ages = global_step - steps
       print("Mean age:", ages.mean())
-            
+      
       #print('After collect: %s' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
-      split('extra_collect')
+      split('collect')
       
       try:
         train_out = self.learner.train(
             experiences, self.batch_steps,
             log=(step%self.log_interval==0),
+            retrieve_kls=self.replay is not None,
+            retrieve_priorities=weights is not None,
+            weights=weights,
+            time_major=True,
         )[-1]
         global_step = train_out['global_step']
+        if self.replay:
+          self.replay.update(indices, train_out['kls'], train_out.get('priorities'))
+        self.collector.global_step = global_step
         # print("global_step", global_step)
         step += 1
       except tf.errors.InvalidArgumentError as e:
@@ -220,7 +276,10 @@ class Trainer(Default):
       # print("Mean KL", np.mean(kls))
       
       #print('After train: %s' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
-      split('train')
+      # summaries ride along with the last train step; charge their share apart
+      train_time = timer.split()
+      averages['summary'].append(self.learner.summary_time)
+      averages['train'].append(train_time - self.learner.summary_time)
 
       if self.pop_size > 1 and sweeps % self.evo_period == 0:
         if self.selection():
@@ -229,9 +288,11 @@ class Trainer(Default):
 
       if self.send:
         #self.params_socket.send_string("", zmq.SNDMORE)
-        params = self.learner.blob()
-        global_step = params['global_step:0']
-        blob = pickle.dumps(params)
+        # actors don't need the critic, optimizer state, etc.
+        values = self.learner.blob(self.learner.actor_variables)
+        global_step = values['global_step:0']
+        credit = self.credit() if self.flow_control else None
+        blob = self.params_codec.encode(values, global_step, credit)
         #print('After blob: %s' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
         self.params_socket.send(blob)
         #print('After send: %s' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
@@ -241,6 +302,12 @@ class Trainer(Default):
       #print('After save: %s' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
       split('save')
       
+      if self.learner.stage_batches:
+        # only once we know what we trained on, and after the broadcast, which
+        # actors may be waiting on for credit
+        staged = self.stage_next(global_step)
+      split('stage')
+      
       if self.diff_objects:
         after = count_objects()
         print(diff_objects(after, before))
@@ -250,7 +317,13 @@ class Trainer(Default):
       time_avgs = [averages[name].avg for name in times]
       total_time = sum(time_avgs)
       time_avgs = [f3(t / total_time) for t in time_avgs]
-      print(sweeps, len(experiences), doa, f3(total_time), *time_avgs)
+      new_doa, doa = self.collector.doa - doa, self.collector.doa
+      print(sweeps, len(ages), new_doa, self.collector.dropped, f3(total_time), *time_avgs)
+      
+      if sweeps % self.log_interval == 0 and self.collector.dead:
+        self.collector.print_doa()
+      if sweeps % self.log_interval == 0 and self.replay:
+        print("Replay buffer: %d experiences, evicted %s" % (len(self.replay), self.replay.evicted))
       #print('Memory usage: %s (kb)' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
 
       if self.objgraph:
@@ -5,19 +5,21 @@ Alternative to train.py. Not run by default.
 """
 
 
-from phillip import ssbm, util, learner
+from phillip import ssbm, util, learner, dataset, columnar
 from phillip.default import Default, Option
-import hickle
+import os
 import time
 
 class ModelTrainer(Default):
   _options = [
-    Option('data', type=str, help='path to experience file'),
+    Option('data', type=str, help='path to experience file, columnar dataset or directory of segments'),
     Option('load', type=str, help='path to params + snapshot'),
     Option('init', action='store_true'),
     Option('batch_size', type=int, default=1),
     Option('valid_batches', type=int, default=1),
     Option('file_limit', type=int, default=0, help="0 means no limit"),
+    Option('shuffle_buffer', type=int, default=1024, help="number of trajectories to shuffle over"),
+    Option('prefetch', type=int, default=4, help="number of batches to prepare ahead of training"),
     Option('epochs', type=int, default=1000000),
   ]
   
@@ -31,6 +33,7 @@ class ModelTrainer(Default):
     else:
       args = util.load_params(load, 'train')
     
+    util.update(args, **kwargs)
     util.pp.pprint(args)
     Default.__init__(self, **args)
 
@@ -43,32 +46,50 @@ class ModelTrainer(Default):
     print("Loading experiences from", self.data)
     
     start_time = time.time()
-    self.experiences = hickle.load(self.data)
+    if columnar.ColumnarDataset.exists(self.data):
+      data = columnar.ColumnarDataset(self.data)
+      self.valid_set, self.train_set = data.split(self.valid_batches * self.batch_size)
+      print("Found %d experiences." % len(data))
+    elif os.path.isdir(self.data):
+      data = dataset.ShardDataset(self.data, limit=self.file_limit)
+      self.valid_set, self.train_set = data.split(self.valid_batches * self.batch_size)
+      print("Found %d experiences in %d segments." % (len(data), len(data.segments)))
+    else:
+      self.load_merged()
     print("Loaded experiences in %d seconds." % (time.time() - start_time))
-    if 'initial' not in self.experiences:
-      self.experiences['initial'] = []
 
-  def train(self):
-    shape = self.experiences['action'].shape
+  def load_merged(self):
+    import hickle
+    experiences = hickle.load(self.data)
+    if 'initial' not in experiences:
+      experiences['initial'] = []
+
+    shape = experiences['action'].shape
     data_size = shape[0]
     
     batches = []
     for i in range(0, data_size, self.batch_size):
-      batches.append(util.deepMap(lambda t: t[i:i+self.batch_size], self.experiences))
+      batches.append(util.deepMap(lambda t: t[i:i+self.batch_size], experiences))
   
-    valid_batches = batches[:self.valid_batches]
-    train_batches = batches[self.valid_batches:]
-    
+    self.valid_set = batches[:self.valid_batches]
+    self.train_set = batches[self.valid_batches:]
+
+  def batches(self, data, epoch):
+    if hasattr(data, 'batches'):
+      return data.batches(self.batch_size, self.shuffle_buffer, self.prefetch, seed=epoch)
+    return data
+
+  def train(self):
     for epoch in range(self.epochs):
       print("Epoch", epoch)
       start_time = time.time()
       
-      for batch in train_batches:
+      for batch in self.batches(self.train_set, epoch):
         self.learner.train(batch, log=False, zipped=True)
       
       print(time.time() - start_time) 
       
-      for batch in valid_batches:
+      for batch in self.batches(self.valid_set, epoch):
         self.learner.train(batch, train=False, zipped=True)
 
       self.learner.save()
@@ -6,6 +6,7 @@ import hashlib
 import os
 import pprint
 import time
+import queue
 
 pp = pprint.PrettyPrinter(indent=2)
 
@@ -215,6 +216,22 @@ def update(dikt, **kwargs):
     elif k not in dikt:
       dikt[k] = None
 
+def population_id(pop_id, evolve=False):
+  """The worker's population id, or -1 if not part of a population.
+
+  Makes it easier to run phillip from the command line if we're doing PBT
+  but don't want to specify the population ID.
+  """
+  if evolve and pop_id < 0:
+    return 0
+  return pop_id
+
+def population_path(path, pop_id):
+  "Where a population member's files live."
+  if pop_id >= 0:
+    return os.path.join(path, str(pop_id))
+  return path
+
 def load_params(path, key=None):
   import json
   with open(path + '/params') as f:
@@ -227,3 +244,26 @@ def load_params(path, key=None):
   params.update(path=path)
   return params
 
+
+def prefetch(iterable, size=1):
+  """Runs an iterable on a background thread, buffering up to size items ahead."""
+  items = queue.Queue(size)
+  done = object()
+  
+  def run():
+    try:
+      for x in iterable:
+        items.put((x, None))
+      items.put((done, None))
+    except Exception as e:
+      items.put((done, e))
+  
+  Thread(target=run, daemon=True).start()
+  
+  while True:
+    x, error = items.get()
+    if error is not None:
+      raise error
+    if x is done:
+      return
+    yield x